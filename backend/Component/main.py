@@ -1,27 +1,112 @@
 #Do not forget to update hte new ngruk thingy
 import os
 import json
-import base64
 import asyncio
 import websockets
-import httpx
 import datetime
+import sys
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.websockets import WebSocketDisconnect
 from twilio.twiml.voice_response import VoiceResponse, Connect, Say, Stream, Gather, Redirect
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
+# Shared helpers live one level up in backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from webhooks import WebhookDispatcher, PartialDebouncer, FileSink, CallbackSink
+from transcripts import TranscriptWriter
+from call_state import Turn, CallStateStore, create_backend
+from openai_client import OpenAIClient, split_first_sentence
+from latency import LatencyStats, TurnTimer
+from audio_taps import AudioTaps
+from frames import get_codec, audio_append
+from realtime import EventRegistry, MediaStreamSession, StreamRegistry, TRANSCRIPT_DELTA_EVENTS, transcript_delta
+from vad import VoiceGate, NUMPY_AVAILABLE
+from realtime_pool import RealtimePool
+from live import LiveHub
+from admission import AdmissionLimiter
+from danger import StreamingMatcher, detector_for, load_code_words
+from alerts import AlertOutbox
+
 load_dotenv()
 
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY_1')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+# Retries for 429/5xx responses from the chat completions API
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+# Stream chat completions and say the first sentence before the rest is generated
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
 PORT = int(os.getenv('PORT', 5050))
 # Add webhook URL config (default to localhost in development)
 FRONTEND_WEBHOOK_URL = os.getenv('FRONTEND_WEBHOOK_URL', 'http://localhost:3000/api/webhook')
+# Comma-separated URLs every webhook batch is sent to (FRONTEND_WEBHOOK_URL if empty or unset)
+WEBHOOK_URLS = [url.strip() for url in os.getenv('WEBHOOK_URLS', FRONTEND_WEBHOOK_URL).split(',') if url.strip()] or [FRONTEND_WEBHOOK_URL]
+# Also append every webhook batch to this JSON-lines file, if set
+WEBHOOK_FILE = os.getenv('WEBHOOK_FILE')
 # Set this to False in production
 WEBHOOK_DEBUG = os.getenv('WEBHOOK_DEBUG', 'true').lower() == 'true'
+# Webhook events are batched per call and flushed on whichever limit is hit first
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 20))
+WEBHOOK_FLUSH_INTERVAL = float(os.getenv('WEBHOOK_FLUSH_INTERVAL', 0.25))
+# Per-call outbound queue bound; stale partials are dropped first when it fills up
+WEBHOOK_MAX_QUEUE = int(os.getenv('WEBHOOK_MAX_QUEUE', 200))
+# A webhook sink is skipped after this many failures in a row, then probed again after WEBHOOK_RESET_TIMEOUT seconds
+WEBHOOK_FAILURE_THRESHOLD = int(os.getenv('WEBHOOK_FAILURE_THRESHOLD', 5))
+WEBHOOK_RESET_TIMEOUT = float(os.getenv('WEBHOOK_RESET_TIMEOUT', 30))
+# Events per call replayed to late /live subscribers, and seconds between keep-alive comments
+LIVE_REPLAY_EVENTS = int(os.getenv('LIVE_REPLAY_EVENTS', 100))
+LIVE_KEEPALIVE = float(os.getenv('LIVE_KEEPALIVE', 15))
+# Partial transcripts are sent at most once per this many ms (latest text wins)
+PARTIAL_DEBOUNCE_MS = int(os.getenv('PARTIAL_DEBOUNCE_MS', 150))
+# Transcript lines are fsynced at most this often (seconds)
+TRANSCRIPT_FSYNC_INTERVAL = float(os.getenv('TRANSCRIPT_FSYNC_INTERVAL', 1.0))
+# Idle calls are evicted after this many seconds; the store never holds more than CALL_STATE_MAX_CALLS
+CALL_STATE_TTL = float(os.getenv('CALL_STATE_TTL', 900))
+CALL_STATE_MAX_CALLS = int(os.getenv('CALL_STATE_MAX_CALLS', 1000))
+# 'memory' for a single worker, or e.g. 'sqlite:///call_state.db' to share calls between workers
+CALL_STATE_BACKEND = os.getenv('CALL_STATE_BACKEND', 'memory')
+WORKERS = int(os.getenv('WORKERS', 1))
+# Print per-stage timings for every Gather turn
+SHOW_TURN_TIMINGS = os.getenv('SHOW_TURN_TIMINGS', 'false').lower() == 'true'
+# JSON codec for media stream frames: auto, orjson, msgspec or json
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto')
+# Send a Twilio mark every N audio frames (0 = only at the end of each response)
+MARK_INTERVAL_FRAMES = int(os.getenv('MARK_INTERVAL_FRAMES', 5))
+# Meter AI audio out to Twilio at playback rate, keeping PACE_LEAD_MS buffered there
+PACE_AUDIO = os.getenv('PACE_AUDIO', 'false').lower() == 'true'
+PACE_LEAD_MS = float(os.getenv('PACE_LEAD_MS', 200))
+# Hold back silent caller audio instead of streaming it all to OpenAI (needs NumPy).
+# Keep VAD_HANGOVER_MS above the server_vad silence duration so turns still end.
+INBOUND_VAD = os.getenv('INBOUND_VAD', 'false').lower() == 'true'
+VAD_THRESHOLD_DBFS = float(os.getenv('VAD_THRESHOLD_DBFS', -45))
+VAD_HANGOVER_MS = float(os.getenv('VAD_HANGOVER_MS', 800))
+VAD_PREROLL_MS = float(os.getenv('VAD_PREROLL_MS', 100))
+# Pre-connected realtime sessions kept ready per profile; each one is a billed, idle
+# OpenAI session that is reconnected every REALTIME_POOL_MAX_IDLE seconds (0 = connect on demand)
+REALTIME_POOL_SIZE = int(os.getenv('REALTIME_POOL_SIZE', 0))
+REALTIME_POOL_MAX_IDLE = float(os.getenv('REALTIME_POOL_MAX_IDLE', 300))
+# Most realtime sessions this worker runs at once (0 for no limit); callers beyond it stay in Gather mode
+MAX_REALTIME_SESSIONS = int(os.getenv('MAX_REALTIME_SESSIONS', 20))
+# Seconds a media stream waits for a realtime session slot before it is turned away
+REALTIME_ADMISSION_WAIT = float(os.getenv('REALTIME_ADMISSION_WAIT', 2))
+# Most chat completions this worker runs at once (0 for no limit)
+MAX_CHAT_REQUESTS = int(os.getenv('MAX_CHAT_REQUESTS', 50))
+# Seconds a turn waits for a chat completion slot before the caller gets the busy reply
+CHAT_ADMISSION_WAIT = float(os.getenv('CHAT_ADMISSION_WAIT', 3))
+# Realtime input transcription model. gpt-4o-transcribe and gpt-4o-mini-transcribe stream partial
+# transcripts, which code words are caught in; with whisper-1 they are only caught once the caller stops
+TRANSCRIPTION_MODEL = os.getenv('TRANSCRIPTION_MODEL', 'gpt-4o-transcribe')
+# Emergency alerts are written to this SQLite outbox and retried until each of WEBHOOK_URLS accepts them
+ALERT_OUTBOX_PATH = os.getenv('ALERT_OUTBOX_PATH', 'alerts.db')
+ALERT_TIMEOUT = float(os.getenv('ALERT_TIMEOUT', 3))
+# Attempts before an undeliverable alert is marked failed in the outbox (0 to retry forever)
+ALERT_MAX_ATTEMPTS = int(os.getenv('ALERT_MAX_ATTEMPTS', 100))
+# JSON list of User documents; callers with code words set get them instead of 'pineapple'
+USERS_FILE = os.getenv('USERS_FILE')
 
 SYSTEM_MESSAGE = (
     "You are a close friend of the user, calling to check in on them. Your goal is to create a natural, believable conversation "
@@ -45,26 +130,124 @@ SYSTEM_MESSAGE = (
     "\n16. Use a natural, human-like voice with appropriate pauses and intonations."
     "\n17. Use a warm, friendly, and natural tone with appropriate pauses."
 )
+SYSTEM_PROMPT = {"role": "system", "content": SYSTEM_MESSAGE}
+# Said instead of an AI reply when no chat completion slot frees up in time
+BUSY_REPLY = "Sorry, give me just a second. Could you say that again?"
+# Said instead of an AI reply when OpenAI returns an error, or the request fails
+API_ERROR_REPLY = "I'm sorry, I'm having trouble connecting to my brain right now. Could you try again?"
+ERROR_REPLY = "I apologize, but I encountered an error processing your request. Let's try again."
+# Fallback replies are said to the caller but never recorded as turns of the conversation
+FALLBACK_REPLIES = frozenset((BUSY_REPLY, API_ERROR_REPLY, ERROR_REPLY))
 # Available voices: 'alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer', 'sage' - try different ones
 VOICE = 'echo'
 # Extended list of event types to track for better insights
-LOG_EVENT_TYPES = [
+LOG_EVENT_TYPES = frozenset([
     'error', 'response.content.done', 'rate_limits.updated',
     'response.done', 'input_audio_buffer.committed',
     'input_audio_buffer.speech_stopped', 'input_audio_buffer.speech_started',
     'session.created',
     'response.audio_transcript.done',
     'conversation.item.input_audio_transcription.completed',
-]
+])
 SHOW_TIMING_MATH = False
-CALL_DURATION_LIMIT = 30  # 4 minutes in seconds : change to 240 sec
+# Media streams are closed after this many seconds (0 for no limit)
+CALL_DURATION_LIMIT = int(os.getenv('CALL_DURATION_LIMIT', 240))  # 4 minutes
+
+# Conversation history and transcripts for each live call
+call_states = CallStateStore(
+    create_backend(CALL_STATE_BACKEND),
+    ttl=CALL_STATE_TTL,
+    max_calls=CALL_STATE_MAX_CALLS
+)
+# Streamed AI responses still generating after their first sentence was said, by call.
+# These only live in this worker, and Twilio can send /continue-response to any worker.
+pending_replies = {}
+if STREAM_RESPONSES and (WORKERS > 1 or call_states.backend.shared):
+    print("Warning: STREAM_RESPONSES is turned off because calls are shared between workers.")
+    STREAM_RESPONSES = False
+
+# One shared webhook sender for every call, fanning out to each configured sink
+webhook_dispatcher = WebhookDispatcher(
+    WEBHOOK_URLS,
+    max_batch=WEBHOOK_BATCH_SIZE,
+    flush_interval=WEBHOOK_FLUSH_INTERVAL,
+    max_queue=WEBHOOK_MAX_QUEUE,
+    failure_threshold=WEBHOOK_FAILURE_THRESHOLD,
+    reset_timeout=WEBHOOK_RESET_TIMEOUT,
+    debug=WEBHOOK_DEBUG
+)
+if WEBHOOK_FILE:
+    webhook_dispatcher.add_sink(FileSink(WEBHOOK_FILE))
+# Emergency alerts get their own durable outbox and connection, ahead of transcript traffic
+alert_outbox = AlertOutbox(
+    WEBHOOK_URLS,
+    path=ALERT_OUTBOX_PATH,
+    timeout=ALERT_TIMEOUT,
+    max_attempts=ALERT_MAX_ATTEMPTS,
+    debug=WEBHOOK_DEBUG
+)
+# Pooled OpenAI client shared by every call
+openai_client = OpenAIClient(OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=OPENAI_MAX_RETRIES)
+# Transcripts are appended as JSON lines by a background writer thread
+transcript_writer = TranscriptWriter(
+    'transcripts',
+    fsync_interval=TRANSCRIPT_FSYNC_INTERVAL,
+    part=os.getpid() if call_states.backend.shared else None
+)
+# Per-stage latency of Gather turns, exposed on /metrics
+turn_latency = LatencyStats()
+# Side effects still running after their turn's TwiML was returned
+background_tasks = set()
+# Consumers of decoded call audio; with none registered the relay never decodes
+audio_taps = AudioTaps()
+# Live media streams and the calls they belong to
+media_streams = StreamRegistry()
+codec = get_codec(JSON_CODEC)
+# Live transcripts and insights for /live subscribers, fed by the webhook dispatcher
+live_hub = LiveHub(replay=LIVE_REPLAY_EVENTS, dumps=codec.dumps)
+webhook_dispatcher.add_sink(CallbackSink(live_hub.publish, name="live"))
+
+async def connect_realtime():
+    return await websockets.connect(
+        'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01',
+        extra_headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "OpenAI-Beta": "realtime=v1"
+        }
+    )
+
+# Realtime sockets connected and configured ahead of the switch to natural conversation mode
+realtime_pool = RealtimePool(connect_realtime, size=REALTIME_POOL_SIZE, max_idle=REALTIME_POOL_MAX_IDLE)
+# Per-worker caps on concurrent realtime sessions and chat completions
+realtime_admission = AdmissionLimiter(MAX_REALTIME_SESSIONS, max_wait=REALTIME_ADMISSION_WAIT)
+chat_admission = AdmissionLimiter(MAX_CHAT_REQUESTS, max_wait=CHAT_ADMISSION_WAIT)
+# Callers' own code words by phone number
+caller_code_words = load_code_words(USERS_FILE) if USERS_FILE else {}
+# Calls that have already raised their emergency alert, and how long raising it took
+alerted_calls = set()
+alert_latency = LatencyStats()
 
-# Store conversation history
-conversation_history = {}
-# For storing complete transcripts with timestamps
-call_transcripts = {}
+@asynccontextmanager
+async def lifespan(app):
+    # Resends any alerts a previous run didn't get out
+    await alert_outbox.start()
+    await webhook_dispatcher.start()
+    await openai_client.start()
+    transcript_writer.start()
+    await call_states.start()
+    await realtime_pool.start()
+    yield
+    # Let in-flight turn side effects land before the stores shut down
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await realtime_pool.stop()
+    await call_states.stop()
+    await webhook_dispatcher.stop()
+    await alert_outbox.stop()
+    await openai_client.stop()
+    await asyncio.to_thread(transcript_writer.stop)
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow cross-origin requests from the frontend
 app.add_middleware(
@@ -78,56 +261,61 @@ app.add_middleware(
 if not OPENAI_API_KEY:
     raise ValueError('Missing the OpenAI API key. Please set it in the .env file.')
 
+if INBOUND_VAD and not NUMPY_AVAILABLE:
+    print("Warning: INBOUND_VAD needs NumPy, which is not installed; sending all caller audio.")
+    INBOUND_VAD = False
+
 # Function to send emergency alerts to the frontend
 async def send_emergency_alert(call_sid, reason="Code word detected"):
     """
-    Send an emergency alert to the frontend when a code word or danger is detected.
+    Queue an emergency alert for the frontend when a code word or danger is detected.
+    
+    The alert is persisted to the alert outbox before this returns, then delivered on its
+    own connection and retried until the frontend accepts it.
     
     Args:
         call_sid: The unique ID of the call
         reason: The reason for the emergency alert
     """
-    try:
-        # Generate a unique ID for this alert
-        unique_id = int(datetime.datetime.now().timestamp() * 1000)
-        
-        # Create the emergency alert data
-        data = {
-            "transcriptions": [],
-            "insights": [
-                {
-                    "id": unique_id,
-                    "type": "emergency",
-                    "text": f"EMERGENCY ALERT: {reason}",
-                    "action": "notify_police",
-                    "time": datetime.datetime.now().strftime("%H:%M:%S"),
-                    "call_sid": call_sid
-                }
-            ]
-        }
-        
-        print(f"🚨 SENDING EMERGENCY ALERT TO FRONTEND: {reason} 🚨")
-        
-        # Send to webhook asynchronously
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                FRONTEND_WEBHOOK_URL,
-                json=data,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code == 200:
-                print(f"Successfully sent emergency alert to frontend")
-            else:
-                print(f"Error sending emergency alert: {response.status_code} - {response.text}")
+    # Generate a unique ID for this alert
+    unique_id = int(datetime.datetime.now().timestamp() * 1000)
     
-    except Exception as e:
-        print(f"Exception when sending emergency alert: {e}")
+    # Create the emergency alert insight
+    insight = {
+        "id": unique_id,
+        "type": "emergency",
+        "text": f"EMERGENCY ALERT: {reason}",
+        "action": "notify_police",
+        "time": datetime.datetime.now().strftime("%H:%M:%S"),
+        "call_sid": call_sid
+    }
+    
+    print(f"🚨 SENDING EMERGENCY ALERT TO FRONTEND: {reason} 🚨")
+    await alert_outbox.submit(call_sid, insight)
+    # The file and live sinks get the alert straight away; the webhook URLs get it from the outbox
+    webhook_dispatcher.offer_local({"transcriptions": [], "insights": [insight]})
 
-# Function to send transcripts to the frontend webhook
-async def send_to_webhook(call_sid, message_type="user", content="", speaker="Caller", confidence=None, is_partial=False):
+async def raise_emergency(call_sid, reason, source, started=None):
     """
-    Send transcription data to the frontend webhook.
+    Send the call's emergency alert unless it already went out.
+    
+    Args:
+        call_sid: The unique ID of the call
+        reason: The reason for the emergency alert
+        source: Where the code word was caught: 'gather', 'partial' or 'transcript'
+        started: perf_counter() time the caller started speaking, to record the time to alert
+    """
+    if call_sid in alerted_calls:
+        return
+    alerted_calls.add(call_sid)
+    if started is not None:
+        alert_latency.record(source, time.perf_counter() - started)
+    await send_emergency_alert(call_sid, reason)
+
+# Function to queue transcripts for the frontend webhook
+async def send_to_webhook(call_sid, message_type="user", content="", speaker="Caller", confidence=None, is_partial=False, detection=None):
+    """
+    Queue transcription data for the frontend webhook.
     
     Args:
         call_sid: The unique ID of the call
@@ -136,75 +324,118 @@ async def send_to_webhook(call_sid, message_type="user", content="", speaker="Ca
         speaker: 'Caller' or 'You' (AI assistant)
         confidence: Confidence score if available
         is_partial: Whether this is a partial transcript (for realtime updates)
+        detection: The message's DangerDetector result, if the caller already scanned it
     """
-    try:
-        # Generate a unique ID for this transcript
-        unique_id = int(datetime.datetime.now().timestamp() * 1000)
-        
-        # Create the data to send
-        data = {
-            "transcriptions": [
-                {
-                    "id": unique_id,
-                    "speaker": "Caller" if message_type == "user" else "You",
-                    "text": content,
-                    "time": datetime.datetime.now().strftime("%H:%M:%S"),
-                    "sentiment": "neutral",  # Could enhance with sentiment analysis
-                    "confidence": confidence,
-                    "call_sid": call_sid,
-                    "is_partial": is_partial
-                }
-            ],
-            "insights": []
-        }
-        
-        # Add insights for certain keywords
-        if message_type == "user" and any(keyword in content.lower() for keyword in ["help", "emergency", "urgent", "scared", "afraid"]):
-            data["insights"].append({
-                "id": unique_id + 1,
-                "type": "warning",
-                "text": f"Detected concern in caller's message: '{content}'"
-            })
-        
-        # Check for the "Pineapple" code word which indicates the user is in danger
-        if message_type == "user" and "pineapple" in content.lower():
-            # We'll send a separate emergency alert instead of just adding an insight
-            await send_emergency_alert(call_sid, "Code word 'pineapple' detected in message")
-            print("🚨 EMERGENCY CODE WORD DETECTED - User is in danger! 🚨")
-        
-        if WEBHOOK_DEBUG:
-            print(f"Sending to webhook: {json.dumps(data, indent=2)}")
-        
-        # Send to webhook asynchronously
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                FRONTEND_WEBHOOK_URL,
-                json=data,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code == 200:
-                if WEBHOOK_DEBUG:
-                    print(f"Successfully sent to webhook: {response.text}")
-            else:
-                print(f"Error sending to webhook: {response.status_code} - {response.text}")
+    # Generate a unique ID for this transcript
+    unique_id = int(datetime.datetime.now().timestamp() * 1000)
     
-    except Exception as e:
-        print(f"Exception when sending to webhook: {e}")
+    transcription = {
+        "id": unique_id,
+        "speaker": "Caller" if message_type == "user" else "You",
+        "text": content,
+        "time": datetime.datetime.now().strftime("%H:%M:%S"),
+        "sentiment": "neutral",  # Could enhance with sentiment analysis
+        "confidence": confidence,
+        "call_sid": call_sid,
+        "is_partial": is_partial
+    }
+    
+    # Add insights for concern words; code word alerts are raised where the utterance is scanned
+    if message_type == "user" and detection is None:
+        detection = detector_for().scan(content)
+    insights = []
+    if detection is not None and detection.concerns:
+        insights.append({
+            "id": unique_id + 1,
+            "type": "warning",
+            "text": f"Detected concern in caller's message: '{content}'",
+            "call_sid": call_sid
+        })
+    
+    # Batched and posted in the background by the dispatcher
+    webhook_dispatcher.submit(call_sid, [transcription], insights)
+
+# Throttle partial transcripts so only the latest text goes out each interval
+async def send_partial_to_webhook(call_sid, message_type, content):
+    await send_to_webhook(
+        call_sid=call_sid,
+        message_type=message_type,
+        content=content,
+        speaker="Caller" if message_type == "user" else "You",
+        confidence=None,
+        is_partial=True
+    )
+
+partial_debouncer = PartialDebouncer(send_partial_to_webhook, interval=PARTIAL_DEBOUNCE_MS / 1000)
 
 @app.get("/", response_class=JSONResponse)
 async def index_page():
     return {"message": "Twilio Media Stream Server is running!"}
 
+@app.get("/metrics", response_class=JSONResponse)
+async def metrics():
+    """Expose internal queue depths and counters."""
+    return {
+        "webhooks": webhook_dispatcher.stats(),
+        "calls": await call_states.stats(),
+        "openai": openai_client.stats(),
+        "turns": turn_latency.stats(),
+        "background_tasks": len(background_tasks),
+        "media_streams": len(media_streams),
+        "realtime_pool": realtime_pool.stats(),
+        "admission": {"realtime": realtime_admission.stats(), "chat": chat_admission.stats()},
+        "time_to_alert": alert_latency.stats(),
+        "alerts": await alert_outbox.stats(),
+        "live": live_hub.stats()
+    }
+
+@app.get("/live")
+async def live_events(request: Request, call_sid: str = None):
+    """
+    Stream transcripts and insights as Server-Sent Events, for one call or all of them.
+    
+    Subscribers first get the call's recent events, or only those after Last-Event-ID
+    when the browser reconnects, then everything new as it is published.
+    """
+    last_id = request.headers.get('last-event-id', '')
+    subscriber = live_hub.subscribe(call_sid, int(last_id) if last_id.isdigit() else 0)
+    
+    async def stream():
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscriber.queue.get(), LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+        finally:
+            live_hub.unsubscribe(subscriber)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/live")
+async def publish_live_events(request: Request):
+    """
+    Publish a batch in the webhook format to /live subscribers.
+    
+    The dashboard's test messages arrive here by way of its /api/webhook route, so they
+    show up on the live stream like any call's transcripts.
+    """
+    live_hub.publish(await request.json())
+    return {"success": True}
+
 @app.api_route("/incoming-call", methods=["GET", "POST"])
 async def handle_incoming_call(request: Request):
     """Initial entry point for incoming calls."""
     form_data = await request.form()
     call_sid = form_data.get('CallSid', 'unknown')
     
-    # Initialize conversation history for this call
-    conversation_history[call_sid] = []
-    call_transcripts[call_sid] = []
+    # Initialize conversation history for this call, with the caller's own code words if they have any
+    state = await call_states.reset(call_sid)
+    code_words = caller_code_words.get(form_data.get('From'))
+    if code_words:
+        state.code_words = code_words
+        await call_states.save(state)
     
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"New call received: {call_sid} at {timestamp}")
@@ -247,29 +478,16 @@ async def start_gather(request: Request):
     
     return HTMLResponse(content=str(response), media_type="application/xml")
 
-async def get_ai_response(user_query, call_sid):
-    """Get a response from OpenAI API."""
-    # Get conversation history for context
-    messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
-    
-    # Add conversation history (up to last 5 exchanges)
-    history = conversation_history.get(call_sid, [])
-    for entry in history[-10:]:  # Last 10 entries
-        if entry.startswith("User: "):
-            messages.append({"role": "user", "content": entry[6:]})
-        elif entry.startswith("AI: "):
-            messages.append({"role": "assistant", "content": entry[4:]})
-    
-    # Add current query
-    messages.append({"role": "user", "content": user_query})
+async def get_ai_response(state):
+    """Get a response from OpenAI API for the call's latest turn."""
+    # System prompt followed by the call's recent turns, ending with the caller's query
+    messages = [SYSTEM_PROMPT, *state.messages()]
     
-    # Make the API call
+    # Make the API call once a chat completion slot is free
+    if not await chat_admission.acquire():
+        print("Chat completion limit reached, answering with the busy reply")
+        return BUSY_REPLY
     try:
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
         data = {
             "model": "gpt-4o",
             "messages": messages,
@@ -277,8 +495,7 @@ async def get_ai_response(user_query, call_sid):
             "temperature": 0.7,
         }
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, headers=headers, json=data)
+        response = await openai_client.post("/chat/completions", data)
             
         if response.status_code == 200:
             response_data = response.json()
@@ -286,10 +503,41 @@ async def get_ai_response(user_query, call_sid):
             return ai_message
         else:
             print(f"Error from OpenAI API: {response.status_code} - {response.text}")
-            return "I'm sorry, I'm having trouble connecting to my brain right now. Could you try again?"
+            return API_ERROR_REPLY
     except Exception as e:
         print(f"Exception when calling OpenAI API: {e}")
-        return "I apologize, but I encountered an error processing your request. Let's try again."
+        return ERROR_REPLY
+    finally:
+        chat_admission.release()
+
+async def stream_ai_response(state):
+    """Yield the OpenAI API's response for the call's latest turn as it is generated."""
+    messages = [SYSTEM_PROMPT, *state.messages()]
+    data = {
+        "model": "gpt-4o",
+        "messages": messages,
+        "max_tokens": 250,
+        "temperature": 0.7,
+    }
+    if not await chat_admission.acquire():
+        print("Chat completion limit reached, answering with the busy reply")
+        yield BUSY_REPLY
+        return
+    produced = False
+    try:
+        async for event in openai_client.stream("/chat/completions", data):
+            choices = event.get("choices")
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if delta:
+                produced = True
+                yield delta
+    except Exception as e:
+        print(f"Exception when streaming from OpenAI API: {e}")
+        # Only fall back if the caller hasn't already heard part of a response
+        if not produced:
+            yield ERROR_REPLY
+    finally:
+        chat_admission.release()
 
 @app.api_route("/process-speech", methods=["GET", "POST"])
 async def process_speech(request: Request):
@@ -299,14 +547,11 @@ async def process_speech(request: Request):
     speech_result = form_data.get('SpeechResult', '')
     confidence = form_data.get('Confidence', '0')
     
-    # Add to conversation history and log
-    if call_sid not in conversation_history:
-        conversation_history[call_sid] = []
+    timer = TurnTimer(turn_latency, "speech")
     
-    if call_sid not in call_transcripts:
-        call_transcripts[call_sid] = []
-    
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Conversation history and log for this call
+    state = await call_states.get(call_sid)
+    response = VoiceResponse()
     
     if speech_result:
         # Log detailed information about the speech recognition
@@ -314,92 +559,93 @@ async def process_speech(request: Request):
         print(f"User said: \"{speech_result}\"")
         print(f"Confidence: {confidence}")
         
-        # Add to conversation history
-        conversation_history[call_sid].append(f"User: {speech_result}")
+        # Scan the utterance once for the caller's code words and concern words
+        detection = detector_for(state.code_words).scan(speech_result)
         
-        # Add to transcript with timestamp
-        call_transcripts[call_sid].append({
-            "role": "user",
-            "content": speech_result,
-            "timestamp": timestamp,
-            "confidence": confidence
-        })
+        # Add to the call's turn log; only the OpenAI call is on the critical path,
+        # so the transcript, state save and webhook run alongside it
+        run_in_background(publish_turn(state, add_turn(state, "user", speech_result, confidence), timer, detection))
         
         # Print full conversation history
         print("\nFull Conversation History:")
-        for entry in conversation_history[call_sid]:
-            print(entry)
+        for turn in state.turns:
+            print(f"{'User' if turn.role == 'user' else 'AI'}: {turn.content}")
         print("")
         
         # Check for emergency code word
-        emergency_detected = "pineapple" in speech_result.lower()
-        if emergency_detected:
+        if detection.code_word:
             print("🚨 EMERGENCY CODE WORD DETECTED IN SPEECH - User is in danger! 🚨")
             # Send emergency alert to frontend
-            await send_emergency_alert(call_sid, "Code word 'pineapple' detected in speech")
+            reason = f"Code word '{detection.code_word}' detected in speech"
+            run_in_background(timed(timer, "emergency", raise_emergency(call_sid, reason, "gather", timer.started)))
         
-        # Send user speech to webhook
-        await send_to_webhook(
-            call_sid=call_sid,
-            message_type="user", 
-            content=speech_result, 
-            speaker="Caller", 
-            confidence=confidence
-        )
-        
-        # Save conversation to file after each exchange
-        save_conversation_to_file(call_sid)
-        
-        # Get AI response from OpenAI
-        ai_response = await get_ai_response(speech_result, call_sid)
-        
-        # Add AI response to conversation history
-        conversation_history[call_sid].append(f"AI: {ai_response}")
-        
-        # Add to transcript with timestamp
-        current_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        call_transcripts[call_sid].append({
-            "role": "assistant",
-            "content": ai_response,
-            "timestamp": current_timestamp
-        })
-        
-        # Send AI response to webhook
-        await send_to_webhook(
-            call_sid=call_sid,
-            message_type="assistant", 
-            content=ai_response, 
-            speaker="You"
-        )
+        async def finish_reply(ai_response):
+            timer.mark("ai_complete")
+            # A fallback isn't something the AI said, so it stays out of the history and transcript
+            if ai_response.strip() in FALLBACK_REPLIES:
+                return
+            # Add AI response to the turn log, then persist and publish it in the background
+            run_in_background(publish_turn(state, add_turn(state, "assistant", ai_response), timer))
         
-        # Create TwiML response
-        response = VoiceResponse()
-        response.say(ai_response)
+        if STREAM_RESPONSES:
+            # Say the first sentence as soon as it exists; the rest is picked up by /continue-response
+            first_sentence, reply = await split_first_sentence(stream_ai_response(state), on_complete=finish_reply)
+            timer.mark("ai_first_sentence")
+            response.say(first_sentence)
+            if not reply.done():
+                pending_replies[call_sid] = (first_sentence, reply)
+                response.redirect('/continue-response')
+                return twiml_response(response, timer)
+        else:
+            # Get AI response from OpenAI
+            ai_response = await get_ai_response(state)
+            await finish_reply(ai_response)
+            response.say(ai_response)
     else:
         print(f"No speech detected for call {call_sid}")
-        conversation_history[call_sid].append("User: [No speech detected]")
-        
-        # Add to transcript with timestamp
-        call_transcripts[call_sid].append({
-            "role": "user",
-            "content": "[No speech detected]",
-            "timestamp": timestamp
-        })
         
-        # Send no speech event to webhook
-        await send_to_webhook(
-            call_sid=call_sid,
-            message_type="user", 
-            content="[No speech detected]", 
-            speaker="Caller"
-        )
+        # Add to the call's turn log and send the no speech event in the background
+        run_in_background(publish_turn(state, add_turn(state, "user", "[No speech detected]"), timer))
         
-        # Create TwiML response
-        response = VoiceResponse()
         response.say("I didn't understand what you said. Let's try again.")
     
+    continue_conversation(response, state)
+    return twiml_response(response, timer)
+
+def twiml_response(response, timer):
+    """Return the turn's TwiML and record how long the caller waited for it."""
+    timer.mark("twiml")
+    if SHOW_TURN_TIMINGS:
+        print(f"Turn timings: {timer.summary()}")
+    return HTMLResponse(content=str(response), media_type="application/xml")
+
+@app.api_route("/continue-response", methods=["GET", "POST"])
+async def continue_response(request: Request):
+    """Say the rest of a streamed AI response once it has finished generating."""
+    form_data = await request.form()
+    call_sid = form_data.get('CallSid', 'unknown')
+    
+    response = VoiceResponse()
+    
+    # Another worker may have served /process-speech; then there's nothing left to say here
+    pending = pending_replies.pop(call_sid, None)
+    if pending:
+        first_sentence, reply = pending
+        try:
+            ai_response = await reply
+            remainder = ai_response.strip()[len(first_sentence):].strip()
+            if remainder:
+                response.say(remainder)
+        except Exception as e:
+            print(f"Error finishing streamed response: {e}")
+    
+    continue_conversation(response, await call_states.get(call_sid))
+    return HTMLResponse(content=str(response), media_type="application/xml")
+
+def continue_conversation(response, state):
+    """Loop back to Gather, offering natural conversation mode once the call has enough turns."""
     # Would you like to continue or switch to media stream?
-    if len(conversation_history[call_sid]) > 10:
+    if state.turn_count > 10:
         # Option to switch to media stream after some exchanges
         gather = Gather(
             input='dtmf',
@@ -414,23 +660,70 @@ async def process_speech(request: Request):
     else:
         # Continue with gather by default
         response.redirect('/start-gather')
-    
-    return HTMLResponse(content=str(response), media_type="application/xml")
+
+def add_turn(state, role, content, confidence=None):
+    """Add a turn to the call's in-memory log, which is all the next prompt needs."""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return state.add_turn(Turn(role, content, timestamp, confidence))
+
+async def persist_turn(state, turn):
+    """Append a turn to the call's transcript file and save the call's state."""
+    transcript_writer.append(state.call_sid, turn.to_dict())
+    await call_states.save(state)
+
+async def record_turn(state, role, content, confidence=None):
+    """Add a turn to the call's log, append it to its transcript file and save the state."""
+    turn = add_turn(state, role, content, confidence)
+    await persist_turn(state, turn)
+    return turn
+
+async def publish_turn(state, turn, timer, detection=None):
+    """Persist a turn and send it to the webhook, timing each side effect."""
+    with timer.stage(f"{turn.role}_persist"):
+        await persist_turn(state, turn)
+    with timer.stage(f"{turn.role}_webhook"):
+        await send_to_webhook(
+            call_sid=state.call_sid,
+            message_type=turn.role,
+            content=turn.content,
+            speaker="Caller" if turn.role == "user" else "You",
+            confidence=turn.confidence,
+            detection=detection
+        )
+
+async def timed(timer, name, coro):
+    """Await a side effect as a named stage of the turn."""
+    with timer.stage(name):
+        return await coro
+
+def run_in_background(coro):
+    """Run a turn's side effect without holding up its TwiML response."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error in background turn task: {task.exception()}")
 
 def save_conversation_to_file(call_sid):
-    """Save the conversation transcript to a file."""
-    try:
-        # Create a directory for transcripts if it doesn't exist
-        os.makedirs('transcripts', exist_ok=True)
-        
-        # Save the conversation transcript
-        filename = f"transcripts/call_{call_sid}_{datetime.datetime.now().strftime('%Y%m%d')}.json"
-        with open(filename, 'w') as f:
-            json.dump(call_transcripts.get(call_sid, []), f, indent=2)
-        
-        print(f"Saved transcript to {filename}")
-    except Exception as e:
-        print(f"Error saving transcript: {e}")
+    """Compact the call's appended transcript lines into its JSON transcript file."""
+    transcript_writer.export(call_sid)
+
+# Flush everything a call still has pending before its state is dropped
+@call_states.on_evict
+def flush_call(call_sid, state):
+    """
+    Persist the transcript and push out pending webhooks for an evicted call;
+    state is None when another worker evicted it.
+    """
+    save_conversation_to_file(call_sid)
+    webhook_dispatcher.flush(call_sid)
+    partial_debouncer.discard(call_sid)
+    pending_replies.pop(call_sid, None)
+    alerted_calls.discard(call_sid)
 
 @app.api_route("/handle-continue-choice", methods=["GET", "POST"])
 async def handle_continue_choice(request: Request):
@@ -459,6 +752,15 @@ async def connect_to_ai(request: Request):
     call_sid = form_data.get('CallSid', 'unknown')
     
     response = VoiceResponse()
+    
+    # Turn the caller back to Gather mode right away rather than queue for a realtime session
+    if not realtime_admission.available:
+        print(f"Realtime session limit reached, keeping call {call_sid} in Gather mode")
+        realtime_admission.reject()
+        response.say("Natural conversation mode is busy right now, so let's keep talking like this.")
+        response.redirect('/start-gather')
+        return HTMLResponse(content=str(response), media_type="application/xml")
+    
     response.say("Connecting you directly to the AI assistant.")
     
     # Get the host for the media stream URL
@@ -469,6 +771,10 @@ async def connect_to_ai(request: Request):
     connect.stream(url=f'wss://{host}/media-stream')
     response.append(connect)
     
+    # Twilio carries on here once the stream ends (e.g. at CALL_DURATION_LIMIT), so say goodbye rather than cut the caller off
+    response.say("Sorry, I've got to go now. Talk to you later!")
+    response.hangup()
+    
     return HTMLResponse(content=str(response), media_type="application/xml")
 
 @app.websocket("/media-stream")
@@ -477,247 +783,270 @@ async def handle_media_stream(websocket: WebSocket):
     print("Media stream client connected")
     await websocket.accept()
 
-    async with websockets.connect(
-        'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01',
-        extra_headers={
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "OpenAI-Beta": "realtime=v1"
-        }
-    ) as openai_ws:
-        await initialize_session(openai_ws)
-
-        # Connection specific state
-        stream_sid = None
-        latest_media_timestamp = 0
-        last_assistant_item = None
-        mark_queue = []
-        response_start_timestamp_twilio = None
-        current_ai_response = ""
-        current_user_input = ""
+    # /connect-to-ai checked for capacity, but another call may have taken the slot since
+    if not await realtime_admission.acquire():
+        print("Realtime session limit reached, closing media stream")
+        await websocket.close()
+        return
+
+    try:
+        # Comes from the pool already connected and configured by initialize_session
+        openai_ws = await realtime_pool.acquire("default")
+        # Have the AI speak first; comment out to let the caller start
+        await send_initial_conversation_item(openai_ws)
+    except BaseException:
+        realtime_admission.release()
+        raise
+
+    # Connection specific state
+    session = MediaStreamSession(
+        websocket, openai_ws,
+        mark_interval=MARK_INTERVAL_FRAMES,
+        pace_lead_ms=PACE_LEAD_MS if PACE_AUDIO else None
+    )
+    # Watch for the default code words until the caller's own are loaded from the start message
+    session.detector = detector_for()
+    session.matcher = StreamingMatcher(session.detector)
+    # Local voice gate in front of OpenAI's server_vad, if enabled
+    voice_gate = VoiceGate(VAD_THRESHOLD_DBFS, VAD_HANGOVER_MS, VAD_PREROLL_MS) if INBOUND_VAD else None
+    
+    async def receive_from_twilio():
+        try:
+            async for message in websocket.iter_text():
+                data = codec.loads(message)
+                if data['event'] == 'media' and openai_ws.open:
+                    session.latest_media_timestamp = int(data['media']['timestamp'])
+                    payload = data['media']['payload']
+                    # Relay the base64 payload as-is; only decode for registered audio consumers
+                    if audio_taps.inbound:
+                        audio_taps.feed_inbound(session.stream_sid, payload)
+                    if voice_gate is None:
+                        await openai_ws.send(audio_append(payload))
+                    else:
+                        for frame in voice_gate.process(payload):
+                            await openai_ws.send(audio_append(frame))
+                elif data['event'] == 'start':
+                    start = data['start']
+                    # Key the stream's turns by its call, so Gather and realtime turns share one transcript
+                    call_sid = start.get('callSid') or start.get('customParameters', {}).get('callSid')
+                    session.start(start['streamSid'], call_sid or start['streamSid'])
+                    media_streams.bind(session.stream_sid, session.call_sid)
+                    session.detector = detector_for((await call_states.get(session.call_sid)).code_words)
+                    session.matcher = StreamingMatcher(session.detector)
+                    print(f"Incoming stream has started {session.stream_sid} for call {session.call_sid}")
+                elif data['event'] == 'mark':
+                    session.mark_played()
+                elif data['event'] == 'stop':
+                    print("Stream ended.")
+                    return
+        except WebSocketDisconnect:
+            print("Client disconnected.")
+
+
+    async def send_to_twilio():
+        """Receive events from the OpenAI Realtime API and hand them to their registered handlers."""
+        try:
+            async for openai_message in openai_ws:
+                await realtime_events.dispatch(session, codec.loads(openai_message))
+        except Exception as e:
+            print(f"Error in send_to_twilio: {e}")
+
+    try:
+        # Whichever side ends first (or the duration limit) ends the whole session
+        reason = await session.run(receive_from_twilio(), send_to_twilio(), time_limit=CALL_DURATION_LIMIT or None)
+        print(f"Media stream {session.stream_sid} ended: {reason}")
+    finally:
+        await session.close()
+        # Evicting the call saves its final transcript, exactly once
+        if session.stream_sid:
+            media_streams.unbind(session.stream_sid)
+            await call_states.evict(session.call_sid)
+        if voice_gate is not None:
+            stats = voice_gate.stats()
+            print(f"Voice gate sent {stats['frames_out']} of {stats['frames_in']} caller frames to OpenAI")
+        realtime_admission.release()
+
+# Handlers for OpenAI realtime events, run as handler(session, event) in registration order.
+# Audio deltas are by far the most frequent event, and nothing else is looked up for them.
+realtime_events = EventRegistry()
+
+@realtime_events.on('response.audio.delta')
+async def relay_audio_delta(session, event):
+    """Send AI audio back to Twilio."""
+    # The delta is already base64 g711 μ-law, which is what Twilio expects
+    audio_payload = event.get('delta')
+    if audio_payload is None:
+        return
+    if audio_taps.outbound:
+        audio_taps.feed_outbound(session.stream_sid, audio_payload)
+
+    if session.response_start_timestamp_twilio is None:
+        session.response_start_timestamp_twilio = session.latest_media_timestamp
+        if SHOW_TIMING_MATH:
+            print(f"Setting start timestamp for new response: {session.response_start_timestamp_twilio}ms")
+
+    # Update last_assistant_item safely
+    if event.get('item_id'):
+        session.last_assistant_item = event['item_id']
+    # Paced audio is queued and sent at playback rate; otherwise it goes straight out
+    if session.pacer is not None:
+        session.pacer.push(audio_payload, session.last_assistant_item)
+    else:
+        await session.send_audio(audio_payload)
+
+
+@realtime_events.on('response.audio.done')
+async def mark_response_end(session, event):
+    """Mark the end of a response so the tail of its audio is tracked too."""
+    if session.pacer is not None:
+        session.pacer.boundary()
+    else:
+        await session.end_response()
+
+@realtime_events.on(*LOG_EVENT_TYPES)
+async def log_event(session, event):
+    print(f"Received event: {event['type']}", event)
+
+@realtime_events.on('conversation.item.input_audio_transcription.completed')
+async def record_user_transcript(session, event):
+    """Add the caller's transcribed speech to the conversation history."""
+    # The full transcript settles the utterance, including its last word
+    session.matcher.reset()
+    call_sid = session.call_sid
+    if 'transcript' in event and call_sid:
+        user_input = event['transcript']
+        await record_turn(await call_states.get(call_sid), "user", user_input)
+        print(f"User transcript: {user_input}")
         
-        async def receive_from_twilio():
-            nonlocal stream_sid, latest_media_timestamp
-            audio_buffer = bytearray()  # Buffer to store raw audio frames
-            try:
-                async for message in websocket.iter_text():
-                    data = json.loads(message)
-                    if data['event'] == 'media' and openai_ws.open:
-                        latest_media_timestamp = int(data['media']['timestamp'])
-                        payload = data['media']['payload']
-                        # Decode and store raw audio data in the buffer.
-                        audio_buffer.extend(base64.b64decode(payload))
-                        audio_append = {
-                            "type": "input_audio_buffer.append",
-                            "audio": payload
-                        }
-                        await openai_ws.send(json.dumps(audio_append))
-                    elif data['event'] == 'start':
-                        stream_sid = data['start']['streamSid']
-                        print(f"Incoming stream has started {stream_sid}")
-                        audio_buffer.clear()  # Clear buffer for a new utterance
-                        latest_media_timestamp = 0
-                    elif data['event'] == 'mark':
-                        if mark_queue:
-                            mark_queue.pop(0)
-                    elif data['event'] == 'stop':
-                        print("Stream ended.")
-                        # Save final transcript
-                        if stream_sid and stream_sid in call_transcripts:
-                            save_conversation_to_file(stream_sid)
-            except WebSocketDisconnect:
-                print("Client disconnected.")
-                if openai_ws.open:
-                    await openai_ws.close()
-                # Save transcript on disconnect
-                if stream_sid and stream_sid in call_transcripts:
-                    save_conversation_to_file(stream_sid)
-
-
-        async def send_to_twilio():
-            """Receive events from the OpenAI Realtime API, send audio back to Twilio."""
-            nonlocal stream_sid, last_assistant_item, response_start_timestamp_twilio, current_ai_response, current_user_input
-            try:
-                async for openai_message in openai_ws:
-                    response = json.loads(openai_message)
-                    if response['type'] in LOG_EVENT_TYPES:
-                        print(f"Received event: {response['type']}", response)
-                        
-                        # Track transcriptions
-                        if response['type'] == 'conversation.item.input_audio_transcription.completed':
-                            if 'transcript' in response:
-                                # Add to conversation history
-                                user_input = response['transcript']
-                                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                
-                                if stream_sid and stream_sid in call_transcripts:
-                                    call_transcripts[stream_sid].append({
-                                        "role": "user",
-                                        "content": user_input,
-                                        "timestamp": timestamp
-                                    })
-                                    print(f"User transcript: {user_input}")
-                                    
-                                    # Check for emergency code word
-                                    emergency_detected = "pineapple" in user_input.lower()
-                                    if emergency_detected:
-                                        print("🚨 EMERGENCY CODE WORD DETECTED IN MEDIA STREAM - User is in danger! 🚨")
-                                        # Send emergency alert to frontend
-                                        await send_emergency_alert(stream_sid, "Code word 'pineapple' detected in conversation")
-                                    
-                                    # Send user transcript to webhook
-                                    await send_to_webhook(
-                                        call_sid=stream_sid,
-                                        message_type="user",
-                                        content=user_input,
-                                        speaker="Caller"
-                                    )
-                        
-                        elif response['type'] == 'response.audio_transcript.done':
-                            if 'transcript' in response:
-                                # Add to conversation history
-                                ai_response = response['transcript']
-                                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                
-                                if stream_sid and stream_sid in call_transcripts:
-                                    call_transcripts[stream_sid].append({
-                                        "role": "assistant",
-                                        "content": ai_response,
-                                        "timestamp": timestamp
-                                    })
-                                    print(f"AI transcript: {ai_response}")
-                                    
-                                    # Send AI transcript to webhook
-                                    await send_to_webhook(
-                                        call_sid=stream_sid,
-                                        message_type="assistant",
-                                        content=ai_response,
-                                        speaker="You"
-                                    )
-
-                    # Capture text content from OpenAI for transcription
-                    if response.get('type') == 'response.content.delta' and 'delta' in response:
-                        current_ai_response += response['delta'].get('text', '')
-                        print(f"AI response text: {current_ai_response}")
-                        
-                        # Send partial AI response to webhook for real-time display
-                        if len(current_ai_response) > 5 and stream_sid:  # Don't send tiny updates
-                            await send_to_webhook(
-                                call_sid=stream_sid,
-                                message_type="assistant",
-                                content=current_ai_response,
-                                speaker="You",
-                                confidence=None,
-                                is_partial=True
-                            )
-
-                    if response.get('type') == 'response.audio.delta' and 'delta' in response:
-                        audio_payload = base64.b64encode(base64.b64decode(response['delta'])).decode('utf-8')
-                        audio_delta = {
-                            "event": "media",
-                            "streamSid": stream_sid,
-                            "media": {
-                                "payload": audio_payload
-                            }
-                        }
-                        await websocket.send_json(audio_delta)
-
-                        if response_start_timestamp_twilio is None:
-                            response_start_timestamp_twilio = latest_media_timestamp
-                            if SHOW_TIMING_MATH:
-                                print(f"Setting start timestamp for new response: {response_start_timestamp_twilio}ms")
-
-                        # Update last_assistant_item safely
-                        if response.get('item_id'):
-                            last_assistant_item = response['item_id']
-
-                        await send_mark(websocket, stream_sid)
-
-                    # When AI response is complete, log the full response
-                    if response.get('type') == 'response.content.done':
-                        print(f"Complete AI response: {current_ai_response}")
-                        # Reset for next response
-                        current_ai_response = ""
-
-                    # Capture user input text from OpenAI's transcription
-                    if response.get('type') == 'input_text.delta' and 'delta' in response:
-                        user_text = response['delta'].get('text', '')
-                        if user_text:
-                            current_user_input += user_text
-                            print(f"User input transcribed by OpenAI: {current_user_input}")
-                            
-                            # Check for emergency code word in partial transcripts
-                            if "pineapple" in current_user_input.lower() and stream_sid:
-                                print("🚨 EMERGENCY CODE WORD DETECTED IN PARTIAL TRANSCRIPT - User is in danger! 🚨")
-                                # Send emergency alert to frontend
-                                await send_emergency_alert(stream_sid, "Code word 'pineapple' detected in real-time")
-                            
-                            # Send partial user input to webhook for real-time display
-                            if len(current_user_input) > 3 and stream_sid:  # Don't send tiny updates
-                                await send_to_webhook(
-                                    call_sid=stream_sid,
-                                    message_type="user",
-                                    content=current_user_input,
-                                    speaker="Caller",
-                                    confidence=None,
-                                    is_partial=True
-                                )
-
-                    # Trigger an interruption. Your use case might work better using `input_audio_buffer.speech_stopped`, or combining the two.
-                    if response.get('type') == 'input_audio_buffer.speech_started':
-                        print("Speech started detected.")
-                        if last_assistant_item:
-                            print(f"Interrupting response with id: {last_assistant_item}")
-                            await handle_speech_started_event()
-                            
-                    # Reset user input when speech stops
-                    if response.get('type') == 'input_audio_buffer.speech_stopped':
-                        if current_user_input:
-                            print(f"Complete user input: {current_user_input}")
-                            current_user_input = ""
-            except Exception as e:
-                print(f"Error in send_to_twilio: {e}")
-
-        async def handle_speech_started_event():
-            """Handle interruption when the caller's speech starts."""
-            nonlocal response_start_timestamp_twilio, last_assistant_item
-            print("Handling speech started event.")
-            if mark_queue and response_start_timestamp_twilio is not None:
-                elapsed_time = latest_media_timestamp - response_start_timestamp_twilio
-                if SHOW_TIMING_MATH:
-                    print(f"Calculating elapsed time for truncation: {latest_media_timestamp} - {response_start_timestamp_twilio} = {elapsed_time}ms")
-
-                if last_assistant_item:
-                    if SHOW_TIMING_MATH:
-                        print(f"Truncating item with ID: {last_assistant_item}, Truncated at: {elapsed_time}ms")
-
-                    truncate_event = {
-                        "type": "conversation.item.truncate",
-                        "item_id": last_assistant_item,
-                        "content_index": 0,
-                        "audio_end_ms": elapsed_time
-                    }
-                    await openai_ws.send(json.dumps(truncate_event))
-
-                await websocket.send_json({
-                    "event": "clear",
-                    "streamSid": stream_sid
-                })
-
-                mark_queue.clear()
-                last_assistant_item = None
-                response_start_timestamp_twilio = None
-
-        async def send_mark(connection, stream_sid):
-            if stream_sid:
-                mark_event = {
-                    "event": "mark",
-                    "streamSid": stream_sid,
-                    "mark": {"name": "responsePart"}
-                }
-                await connection.send_json(mark_event)
-                mark_queue.append('responsePart')
+        # Check for emergency code word
+        detection = session.detector.scan(user_input)
+        if detection.code_word:
+            print("🚨 EMERGENCY CODE WORD DETECTED IN MEDIA STREAM - User is in danger! 🚨")
+            # Send emergency alert to frontend
+            reason = f"Code word '{detection.code_word}' detected in conversation"
+            await raise_emergency(call_sid, reason, "transcript", session.speech_started_at)
+        
+        # Send user transcript to webhook
+        await send_to_webhook(
+            call_sid=call_sid,
+            message_type="user",
+            content=user_input,
+            speaker="Caller",
+            detection=detection
+        )
+
+@realtime_events.on('response.audio_transcript.delta')
+async def update_assistant_partial(session, event):
+    """Capture the transcript of the AI's speech as it streams in."""
+    if not event.get('delta'):
+        return
+    session.current_ai_response += event['delta']
+    print(f"AI response text: {session.current_ai_response}")
+    
+    # Send partial AI response to webhook for real-time display
+    if len(session.current_ai_response) > 5 and session.call_sid:  # Don't send tiny updates
+        partial_debouncer.update(session.call_sid, "assistant", session.current_ai_response)
+
+@realtime_events.on('response.audio_transcript.done')
+async def finish_assistant_partial(session, event):
+    """When AI response is complete, log it and send the last partial ahead of the final transcript."""
+    print(f"Complete AI response: {session.current_ai_response}")
+    # Push the final partial out now instead of waiting for the debounce timer
+    if session.call_sid:
+        await partial_debouncer.flush(session.call_sid, "assistant")
+    # Reset for next response
+    session.current_ai_response = ""
 
-        await asyncio.gather(receive_from_twilio(), send_to_twilio())
+@realtime_events.on('response.audio_transcript.done')
+async def record_assistant_transcript(session, event):
+    """Add the AI's spoken response to the conversation history."""
+    call_sid = session.call_sid
+    if 'transcript' in event and call_sid:
+        ai_response = event['transcript']
+        await record_turn(await call_states.get(call_sid), "assistant", ai_response)
+        print(f"AI transcript: {ai_response}")
+        
+        # Send AI transcript to webhook
+        await send_to_webhook(
+            call_sid=call_sid,
+            message_type="assistant",
+            content=ai_response,
+            speaker="You"
+        )
+
+@realtime_events.on(*TRANSCRIPT_DELTA_EVENTS)
+async def update_user_partial(session, event):
+    """Capture user input text from OpenAI's transcription."""
+    user_text = transcript_delta(event)
+    if not user_text:
+        return
+    session.current_user_input += user_text
+    print(f"User input transcribed by OpenAI: {session.current_user_input}")
+    
+    # Check each delta for an emergency code word, so the alert goes out before the caller finishes speaking
+    code_word = session.matcher.feed(user_text, event.get('item_id'))
+    if code_word:
+        print("🚨 EMERGENCY CODE WORD DETECTED IN PARTIAL TRANSCRIPT - User is in danger! 🚨")
+        # Send emergency alert to frontend
+        await raise_emergency(session.call_sid, f"Code word '{code_word}' detected in real-time", "partial", session.speech_started_at)
+    
+    # Send partial user input to webhook for real-time display
+    if len(session.current_user_input) > 3 and session.call_sid:  # Don't send tiny updates
+        partial_debouncer.update(session.call_sid, "user", session.current_user_input)
+
+@realtime_events.on('input_audio_buffer.speech_started')
+async def note_speech_started(session, event):
+    """Remember when the caller's utterance began, for the time to alert."""
+    session.speech_started_at = time.perf_counter()
+
+# Trigger an interruption. Your use case might work better using `input_audio_buffer.speech_stopped`, or combining the two.
+@realtime_events.on('input_audio_buffer.speech_started')
+async def handle_speech_started_event(session, event):
+    """Handle interruption when the caller's speech starts."""
+    print("Speech started detected.")
+    if not session.last_assistant_item:
+        return
+    print(f"Interrupting response with id: {session.last_assistant_item}")
+    print("Handling speech started event.")
+    if session.pacer is not None:
+        # The pacer knows exactly how much of the item the caller heard, and unsent audio never reaches Twilio
+        if not (session.pacer.active or session.playing):
+            return
+        played_item = session.pacer.item_id
+        played_ms = session.pacer.clear()
+        elapsed_time = played_ms if played_item == session.last_assistant_item else 0
+    elif session.playing and session.response_start_timestamp_twilio is not None:
+        elapsed_time = session.latest_media_timestamp - session.response_start_timestamp_twilio
+        if SHOW_TIMING_MATH:
+            print(f"Calculating elapsed time for truncation: {session.latest_media_timestamp} - {session.response_start_timestamp_twilio} = {elapsed_time}ms")
+    else:
+        return
+    if SHOW_TIMING_MATH:
+        print(f"Truncating item with ID: {session.last_assistant_item}, Truncated at: {elapsed_time}ms")
+
+    truncate_event = {
+        "type": "conversation.item.truncate",
+        "item_id": session.last_assistant_item,
+        "content_index": 0,
+        "audio_end_ms": elapsed_time
+    }
+    await session.openai_ws.send(codec.dumps(truncate_event))
+
+    await session.websocket.send_text(session.frames.clear)
+
+    session.clear_marks()
+    session.last_assistant_item = None
+    session.response_start_timestamp_twilio = None
+
+@realtime_events.on('input_audio_buffer.speech_stopped')
+async def finish_user_partial(session, event):
+    """Reset user input when speech stops."""
+    session.matcher.reset()
+    if session.current_user_input:
+        print(f"Complete user input: {session.current_user_input}")
+        session.current_user_input = ""
+    if session.call_sid:
+        await partial_debouncer.flush(session.call_sid, "user")
 
 async def send_initial_conversation_item(openai_ws):
     """Send initial conversation item if AI talks first."""
@@ -751,16 +1080,20 @@ async def initialize_session(openai_ws):
             "modalities": ["text", "audio"],
             "temperature": 0.8,
             "input_audio_transcription": {
-                "model": "whisper-1"
+                "model": TRANSCRIPTION_MODEL
             }
         }
     }
     print('Sending session update:', json.dumps(session_update))
     await openai_ws.send(json.dumps(session_update))
 
-    # Uncomment the next line to have the AI speak first
-    await send_initial_conversation_item(openai_ws)
+realtime_pool.add_profile("default", initialize_session)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    if WORKERS > 1:
+        if CALL_STATE_BACKEND == 'memory':
+            print("Warning: the memory call state backend is per worker; set CALL_STATE_BACKEND to share calls between workers.")
+        uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
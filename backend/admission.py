@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+from latency import LatencyStats
+
+
+class AdmissionLimiter:
+    """
+    Caps how many units of one kind of work a worker runs at once.
+
+    acquire() waits at most max_wait seconds for a slot and returns False
+    instead of queueing any longer, so callers can take a cheaper path
+    rather than degrade every call. A limit of 0 or less admits everything.
+    How long admitted callers waited is kept in a LatencyStats.
+    """
+
+    def __init__(self, limit, max_wait=0.0):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        self.counters = {"admitted": 0, "rejected": 0}
+        self.waits = LatencyStats()
+        self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+
+    @property
+    def available(self):
+        """Whether a slot is free right now, without taking it."""
+        return self._semaphore is None or (self.active < self.limit and not self.waiting)
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._admit(0.0)
+            return True
+        start = time.perf_counter()
+        if self._semaphore.locked() and self.max_wait <= 0:
+            self.counters["rejected"] += 1
+            return False
+        self.waiting += 1
+        try:
+            async with asyncio.timeout(self.max_wait if self.max_wait > 0 else None):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            self.counters["rejected"] += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self._admit(time.perf_counter() - start)
+        return True
+
+    def reject(self):
+        """Count a caller turned away after checking available."""
+        self.counters["rejected"] += 1
+
+    def release(self):
+        self.active -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def stats(self):
+        return dict(
+            self.counters,
+            limit=self.limit,
+            active=self.active,
+            waiting=self.waiting,
+            wait=self.waits.stats().get("wait")
+        )
+
+    def _admit(self, waited):
+        self.active += 1
+        self.counters["admitted"] += 1
+        self.waits.record("wait", waited)
@@ -0,0 +1,242 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+import httpx
+
+from latency import LatencyStats
+
+
+class AlertOutbox:
+    """
+    Delivery lane for emergency alerts, kept apart from transcript traffic.
+
+    submit() writes the alert to a local SQLite outbox, once for each of
+    urls, before anything is sent, so alerts survive a crash or restart and
+    are resent on start(). Each URL's delivery is tracked on its own, so a
+    dead receiver never holds up or fails the alert for the others.
+    Each pending alert is posted by its own task over the outbox's small
+    connection pool, never behind transcript batches or a slow earlier
+    alert, and failures are retried with a short exponential backoff. Every
+    post carries the alert's Idempotency-Key and its insight keeps the same
+    id, so a retry after a lost response is recognised as a duplicate
+    rather than shown twice.
+
+    All database work, including the fsync of each submit, runs on the
+    outbox's own thread, so the event loop never waits on the disk. Workers
+    sharing one outbox file claim an alert with a lease before posting it,
+    so each attempt is made by a single worker; a worker that dies mid-send
+    leaves the alert to whoever picks it up once the lease runs out.
+
+    Responses other than 408, 429 and 5xx are treated as permanent failures,
+    as is running out of max_attempts (0 for no limit); those alerts stay in
+    the outbox, marked failed, for inspection.
+    """
+
+    def __init__(self, urls, path="alerts.db", timeout=3.0, retry_base=0.2, retry_max=5.0,
+                 max_attempts=100, debug=False):
+        self.urls = list(urls)
+        if not self.urls:
+            # An alert with nowhere to go would be reported as submitted and never sent
+            raise ValueError("AlertOutbox needs at least one URL to deliver alerts to")
+        self.path = path
+        self.timeout = timeout
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        # Long enough that a claimed alert is never posted twice at once
+        self.lease = max(30.0, timeout * 4)
+        self.debug = debug
+        self.counters = {"submitted": 0, "delivered": 0, "retries": 0, "failed": 0}
+        self.latency = LatencyStats()
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._executor = None
+        self._db = None
+        self._client = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        # Delivery tasks in flight
+        self._sending = set()
+
+    async def start(self):
+        """Open the alert connection and start delivering, including alerts left from a previous run."""
+        if self._task is not None:
+            return
+        await self._run_db(self._open)
+        self._wakeup = asyncio.Event()
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=2 * max(1, len(self.urls)), max_keepalive_connections=2 * max(1, len(self.urls))),
+            headers={"Content-Type": "application/json"}
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self._sending:
+            task.cancel()
+        await asyncio.gather(*self._sending, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        await self._run_db(self._close)
+        self._executor.shutdown()
+        self._executor = None
+
+    async def submit(self, call_sid, insight):
+        """Persist an emergency insight for every URL and wake the worker to deliver it; returns the idempotency keys."""
+        now = time.time()
+        payload = json.dumps(insight)
+        rows = [(uuid.uuid4().hex, url, call_sid, payload, now, now) for url in self.urls]
+        await self._run_db(
+            self._executemany,
+            "INSERT INTO alert_outbox (key, url, call_sid, payload, created, next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        self.counters["submitted"] += 1
+        self._wakeup.set()
+        return [row[0] for row in rows]
+
+    async def stats(self):
+        pending, failed = await self._run_db(
+            self._fetchone,
+            "SELECT COUNT(*) - COALESCE(SUM(failed), 0), COALESCE(SUM(failed), 0) FROM alert_outbox",
+            ()
+        )
+        return dict(self.counters, pending=pending, failed_stored=failed, latency=self.latency.stats())
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # An alert has to be on disk once submit() returns
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_outbox ("
+            "key TEXT PRIMARY KEY, call_sid TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, failed INTEGER NOT NULL DEFAULT 0, "
+            "owner TEXT, lease_until REAL NOT NULL DEFAULT 0, url TEXT)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(alert_outbox)")}
+        if "lease_until" not in columns:
+            # Outboxes written before alerts were leased
+            self._db.execute("ALTER TABLE alert_outbox ADD COLUMN owner TEXT")
+            self._db.execute("ALTER TABLE alert_outbox ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+        if "url" not in columns:
+            # Outboxes written when every alert went to a single URL, which is urls[0]
+            self._db.execute("ALTER TABLE alert_outbox ADD COLUMN url TEXT")
+        # Alerts left unclaimed by a previous run are due now
+        self._db.execute(
+            "UPDATE alert_outbox SET next_attempt = ? WHERE failed = 0 AND lease_until <= ?",
+            (time.time(), time.time())
+        )
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _execute(self, sql, params):
+        self._db.execute(sql, params)
+
+    def _executemany(self, sql, rows):
+        self._db.executemany(sql, rows)
+
+    def _fetchone(self, sql, params):
+        return self._db.execute(sql, params).fetchone()
+
+    def _claim(self):
+        """Lease every due alert to this worker; returns them and when the next one is due."""
+        now = time.time()
+        claimed = self._db.execute(
+            "UPDATE alert_outbox SET owner = ?, lease_until = ? "
+            "WHERE failed = 0 AND next_attempt <= ? AND lease_until <= ? "
+            "RETURNING key, url, payload, created, attempts",
+            (self._owner, now + self.lease, now, now)
+        ).fetchall()
+        next_due = self._db.execute(
+            "SELECT MIN(MAX(next_attempt, lease_until)) FROM alert_outbox WHERE failed = 0"
+        ).fetchone()[0]
+        return claimed, next_due
+
+    async def _run_db(self, method, *args):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="alert-outbox")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed, next_due = await self._run_db(self._claim)
+            except Exception as e:
+                print(f"Error reading alert outbox: {e}")
+                claimed, next_due = [], time.time() + self.retry_max
+            for alert in sorted(claimed, key=lambda alert: alert[3]):
+                task = asyncio.create_task(self._attempt(*alert))
+                self._sending.add(task)
+                task.add_done_callback(self._sent)
+            delay = None if next_due is None else max(0.0, next_due - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _sent(self, task):
+        self._sending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error delivering emergency alert: {task.exception()}")
+        self._wakeup.set()
+
+    async def _attempt(self, key, url, payload, created, attempts):
+        url = url or self.urls[0]
+        insight = json.loads(payload)
+        data = {"transcriptions": [], "insights": [insight]}
+        start = time.perf_counter()
+        error = None
+        try:
+            if self.debug:
+                print(f"Sending emergency alert {key} to {url}: {payload}")
+            response = await self._client.post(url, json=data, headers={"Idempotency-Key": key})
+            status = response.status_code
+        except Exception as e:
+            error = e
+            status = None
+        self.latency.record("attempt", time.perf_counter() - start)
+        if status is not None and 200 <= status < 300:
+            await self._run_db(self._execute, "DELETE FROM alert_outbox WHERE key = ?", (key,))
+            self.counters["delivered"] += 1
+            # Wall clock, since an alert may have been submitted before a restart
+            self.latency.record("delivery", time.time() - created)
+            return
+        attempts += 1
+        permanent = status is not None and status < 500 and status not in (408, 429)
+        if permanent or (self.max_attempts and attempts >= self.max_attempts):
+            reason = f"rejected with {status}" if permanent else f"undelivered after {attempts} attempts"
+            print(f"Emergency alert {key} to {url} {reason}; not retrying")
+            self.counters["failed"] += 1
+            await self._run_db(
+                self._execute,
+                "UPDATE alert_outbox SET attempts = ?, failed = 1, lease_until = 0 WHERE key = ?",
+                (attempts, key)
+            )
+            return
+        # An unreachable frontend would otherwise log every few seconds per alert
+        if attempts == 1 or attempts % 10 == 0:
+            print(f"Emergency alert {key} to {url} failed (attempt {attempts}): {error or status}")
+        self.counters["retries"] += 1
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        await self._run_db(
+            self._execute,
+            "UPDATE alert_outbox SET attempts = ?, next_attempt = ?, lease_until = 0 WHERE key = ?",
+            (attempts, time.time() + delay, key)
+        )
@@ -0,0 +1,41 @@
+import base64
+
+
+class AudioTaps:
+    """
+    Optional consumers of decoded media stream audio.
+
+    The relay between Twilio and OpenAI forwards base64 payloads untouched;
+    audio is only decoded when a consumer (recorder, VAD, analytics) has been
+    registered for that direction. Consumers are called as
+    consumer(stream_sid, audio) with raw g711 μ-law bytes, on the event loop,
+    so they must not block.
+    """
+
+    def __init__(self):
+        self.inbound = []
+        self.outbound = []
+
+    def on_inbound(self, consumer):
+        """Register a consumer for caller audio; also usable as a decorator."""
+        self.inbound.append(consumer)
+        return consumer
+
+    def on_outbound(self, consumer):
+        """Register a consumer for AI audio; also usable as a decorator."""
+        self.outbound.append(consumer)
+        return consumer
+
+    def feed_inbound(self, stream_sid, payload):
+        self._feed(self.inbound, stream_sid, payload)
+
+    def feed_outbound(self, stream_sid, payload):
+        self._feed(self.outbound, stream_sid, payload)
+
+    def _feed(self, consumers, stream_sid, payload):
+        audio = base64.b64decode(payload)
+        for consumer in consumers:
+            try:
+                consumer(stream_sid, audio)
+            except Exception as e:
+                print(f"Error in audio consumer for stream {stream_sid}: {e}")
@@ -0,0 +1,57 @@
+"""
+Per-turn call state load/store latency for each call state backend.
+
+Simulates the /process-speech pattern: load a call's state, append a user
+and an assistant turn, and save it back.
+
+    python benchmarks/call_state_bench.py [--calls 200] [--turns 20]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from call_state import Turn, CallStateStore, MemoryCallStateBackend, SQLiteCallStateBackend
+
+
+async def run(store, calls, turns):
+    timings = []
+    for turn in range(turns):
+        for call in range(calls):
+            start = time.perf_counter()
+            state = await store.get(f"CA{call:032d}")
+            state.add_turn(Turn("user", f"turn {turn} from the caller, long enough to look like real speech",
+                                "2025-03-02 09:40:43", "0.8959558"))
+            state.add_turn(Turn("assistant", f"turn {turn} from the assistant, also about a sentence long",
+                                "2025-03-02 09:40:44"))
+            await store.save(state)
+            timings.append(time.perf_counter() - start)
+    await store.stop()
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:>8}: mean {statistics.mean(timings) * 1e6:8.1f} us"
+          f"  p50 {statistics.median(timings) * 1e6:8.1f} us  p99 {p99 * 1e6:8.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+
+    report("memory", asyncio.run(run(CallStateStore(MemoryCallStateBackend()), args.calls, args.turns)))
+    with tempfile.TemporaryDirectory() as directory:
+        backend = SQLiteCallStateBackend(os.path.join(directory, "call_state.db"))
+        report("sqlite", asyncio.run(run(CallStateStore(backend), args.calls, args.turns)))
+
+
+if __name__ == "__main__":
+    main()
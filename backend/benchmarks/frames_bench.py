@@ -0,0 +1,80 @@
+"""
+Per-frame cost of decoding and encoding media stream WebSocket frames with
+each available JSON codec, and of the pre-templated media envelopes.
+
+Uses realistic frames: a 20 ms Twilio media frame (160 bytes of μ-law) and
+a 100 ms OpenAI response.audio.delta.
+
+    python benchmarks/frames_bench.py [--frames 200000]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frames import get_codec, audio_append, TwilioFrames
+
+STREAM_SID = "MZ18ad3ab5a668481ce02b83e7395059f0"
+TWILIO_PAYLOAD = base64.b64encode(os.urandom(160)).decode()
+OPENAI_DELTA = base64.b64encode(os.urandom(800)).decode()
+
+TWILIO_MEDIA = json.dumps({
+    "event": "media",
+    "sequenceNumber": "4",
+    "media": {"track": "inbound", "chunk": "2", "timestamp": "5", "payload": TWILIO_PAYLOAD},
+    "streamSid": STREAM_SID
+})
+OPENAI_AUDIO_DELTA = json.dumps({
+    "type": "response.audio.delta",
+    "event_id": "event_4950",
+    "response_id": "resp_001",
+    "item_id": "msg_008",
+    "output_index": 0,
+    "content_index": 0,
+    "delta": OPENAI_DELTA
+})
+
+
+def per_frame(fn, frames):
+    return timeit.timeit(fn, number=frames) / frames * 1e9
+
+
+def report(name, nanoseconds):
+    print(f"{name:>40}: {nanoseconds:8.0f} ns/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=200000)
+    args = parser.parse_args()
+
+    codecs = [get_codec("json")]
+    for name in ("orjson", "msgspec"):
+        try:
+            codecs.append(get_codec(name))
+        except ValueError:
+            print(f"{name} not installed, skipping")
+
+    for codec in codecs:
+        report(f"{codec.name} decode twilio media", per_frame(lambda: codec.loads(TWILIO_MEDIA), args.frames))
+        report(f"{codec.name} decode openai audio delta", per_frame(lambda: codec.loads(OPENAI_AUDIO_DELTA), args.frames))
+        report(f"{codec.name} encode audio append", per_frame(
+            lambda: codec.dumps({"type": "input_audio_buffer.append", "audio": TWILIO_PAYLOAD}), args.frames))
+        report(f"{codec.name} encode twilio media", per_frame(
+            lambda: codec.dumps({"event": "media", "streamSid": STREAM_SID, "media": {"payload": OPENAI_DELTA}}),
+            args.frames))
+
+    frames = TwilioFrames(STREAM_SID)
+    report("template audio append", per_frame(lambda: audio_append(TWILIO_PAYLOAD), args.frames))
+    report("template twilio media", per_frame(lambda: frames.media(OPENAI_DELTA), args.frames))
+
+    assert json.loads(audio_append(TWILIO_PAYLOAD)) == {"type": "input_audio_buffer.append", "audio": TWILIO_PAYLOAD}
+    assert json.loads(frames.media(OPENAI_DELTA)) == {
+        "event": "media", "streamSid": STREAM_SID, "media": {"payload": OPENAI_DELTA}}
+
+
+if __name__ == "__main__":
+    main()
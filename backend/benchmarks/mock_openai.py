@@ -0,0 +1,98 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint.
+
+Answers POST /v1/chat/completions after a configurable delay, or streams the
+reply word by word when the request sets "stream": true. It can be told to
+fail a fraction of requests with 429 (with x-ratelimit-reset-requests) or
+503, so client latency and retry behaviour can be measured offline. Point the
+app at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1.
+
+    python benchmarks/mock_openai.py [--port 8765] [--latency 0.2] [--rate-limit 0.1]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY = "Yeah, I'm here. I can stay on the line with you for a bit. Where are you right now?"
+
+
+def create_app(latency=0.2, rate_limit=0.0, server_error=0.0, chunk_delay=0.02):
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        app.state.requests += 1
+        roll = random.random()
+        if roll < rate_limit:
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status_code=429,
+                headers={"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "50ms"}
+            )
+        if roll < rate_limit + server_error:
+            return JSONResponse({"error": {"message": "Overloaded"}}, status_code=503)
+        headers = {"x-ratelimit-remaining-requests": "4999", "x-ratelimit-reset-requests": "12ms"}
+        if payload.get("stream"):
+            return StreamingResponse(_stream(latency, chunk_delay), media_type="text/event-stream", headers=headers)
+        await asyncio.sleep(latency)
+        return JSONResponse({
+            "id": f"chatcmpl-mock-{app.state.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY}, "finish_reason": "stop"}]
+        }, headers=headers)
+
+    return app
+
+
+async def _stream(latency, chunk_delay):
+    # A quarter of the latency before the first token, then one word per chunk
+    await asyncio.sleep(latency / 4)
+    for word in REPLY.split(" "):
+        chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(chunk_delay)
+    yield "data: [DONE]\n\n"
+
+
+class MockOpenAIServer:
+    """Runs the mock app with uvicorn inside the current event loop."""
+
+    def __init__(self, port=8765, **options):
+        self.port = port
+        self.app = create_app(**options)
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=port, log_level="warning"))
+        self._task = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._server.serve())
+        while not self._server.started:
+            await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.should_exit = True
+        await self._task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--server-error", type=float, default=0.0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.rate_limit, args.server_error), host="127.0.0.1", port=args.port)
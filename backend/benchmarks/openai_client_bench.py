@@ -0,0 +1,107 @@
+"""
+Chat completion latency through the shared OpenAIClient versus a new
+httpx.AsyncClient per request, against the local mock server. With --stream
+it instead compares time to the first sentence of a streamed reply with the
+time to the full reply, which is what the caller hears as dead air.
+
+    python benchmarks/openai_client_bench.py [--requests 200] [--concurrency 20] [--rate-limit 0.1] [--stream]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from openai_client import OpenAIClient, split_first_sentence
+from mock_openai import MockOpenAIServer
+
+PAYLOAD = {
+    "model": "gpt-4o",
+    "messages": [{"role": "user", "content": "hey, are you there?"}],
+    "max_tokens": 250,
+    "temperature": 0.7,
+}
+
+
+async def per_request_client(base_url):
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        return await client.post(f"{base_url}/chat/completions", json=PAYLOAD)
+
+
+async def measure(send, requests, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    timings = []
+    failures = 0
+
+    async def one():
+        nonlocal failures
+        async with limit:
+            start = time.perf_counter()
+            response = await send()
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return sorted(timings), failures
+
+
+def report(name, timings, failures):
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:>20}: p50 {statistics.median(timings) * 1000:7.1f} ms"
+          f"  p99 {p99 * 1000:7.1f} ms  failed {failures}")
+
+
+async def stream_deltas(client):
+    async for event in client.stream("/chat/completions", PAYLOAD):
+        delta = event["choices"][0]["delta"].get("content")
+        if delta:
+            yield delta
+
+
+async def measure_stream(client, requests):
+    first_timings, full_timings = [], []
+    for _ in range(requests):
+        start = time.perf_counter()
+        _, task = await split_first_sentence(stream_deltas(client))
+        first_timings.append(time.perf_counter() - start)
+        await task
+        full_timings.append(time.perf_counter() - start)
+    return sorted(first_timings), sorted(full_timings)
+
+
+async def main(args):
+    async with MockOpenAIServer(port=args.port, latency=args.latency, rate_limit=args.rate_limit) as server:
+        if args.stream:
+            client = OpenAIClient("sk-mock", base_url=server.base_url, max_retries=args.retries)
+            await client.start()
+            first_timings, full_timings = await measure_stream(client, args.requests)
+            await client.stop()
+            report("first sentence", first_timings, 0)
+            report("full reply", full_timings, 0)
+            return
+        timings, failures = await measure(lambda: per_request_client(server.base_url), args.requests, args.concurrency)
+        report("client per request", timings, failures)
+
+        client = OpenAIClient("sk-mock", base_url=server.base_url, max_retries=args.retries)
+        await client.start()
+        timings, failures = await measure(lambda: client.post("/chat/completions", PAYLOAD), args.requests, args.concurrency)
+        await client.stop()
+        report("shared client", timings, failures)
+        print(f"shared client stats: {client.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--stream", action="store_true")
+    asyncio.run(main(parser.parse_args()))
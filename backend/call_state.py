@@ -0,0 +1,325 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import sqlite3
+import time
+
+
+class Turn:
+    """One utterance in a call, plus its ready-made chat completion message."""
+
+    __slots__ = ("role", "content", "timestamp", "confidence", "message")
+
+    def __init__(self, role, content, timestamp, confidence=None):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.confidence = confidence
+        self.message = {"role": role, "content": content}
+
+    def to_dict(self):
+        """The record format used in transcript files."""
+        entry = {"role": self.role, "content": self.content, "timestamp": self.timestamp}
+        if self.confidence is not None:
+            entry["confidence"] = self.confidence
+        return entry
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry["role"], entry["content"], entry["timestamp"], entry.get("confidence"))
+
+
+class CallState:
+    """
+    Everything kept for one call between Twilio webhooks.
+
+    turns only holds the last MAX_TURNS turns, which is all the prompt needs;
+    the full transcript lives in the transcript files. turn_count keeps the
+    total number of turns in the call. code_words are the caller's own
+    code words, if they have any.
+    """
+
+    __slots__ = ("call_sid", "turns", "turn_count", "last_active", "code_words")
+
+    MAX_TURNS = 10
+
+    def __init__(self, call_sid, turns=(), turn_count=0, last_active=None, code_words=()):
+        self.call_sid = call_sid
+        self.turns = collections.deque(turns, maxlen=self.MAX_TURNS)
+        self.turn_count = turn_count
+        self.last_active = last_active if last_active is not None else time.time()
+        self.code_words = tuple(code_words)
+
+    def add_turn(self, turn):
+        self.turns.append(turn)
+        self.turn_count += 1
+        return turn
+
+    def messages(self):
+        """Chat completion messages for the recent turns, oldest first."""
+        return [turn.message for turn in self.turns]
+
+    def to_json(self):
+        return json.dumps({
+            "turns": [turn.to_dict() for turn in self.turns],
+            "turn_count": self.turn_count,
+            "code_words": self.code_words
+        })
+
+    @classmethod
+    def from_json(cls, call_sid, data, last_active):
+        data = json.loads(data)
+        turns = [Turn.from_dict(entry) for entry in data["turns"]]
+        return cls(call_sid, turns, data["turn_count"], last_active, data.get("code_words", ()))
+
+
+class MemoryCallStateBackend:
+    """Keeps call state in this process only; the default for a single worker."""
+
+    shared = False
+
+    def __init__(self):
+        self._calls = collections.OrderedDict()
+
+    def load(self, call_sid):
+        state = self._calls.get(call_sid)
+        if state is not None:
+            self._calls.move_to_end(call_sid)
+        return state
+
+    def store(self, state):
+        self._calls[state.call_sid] = state
+        self._calls.move_to_end(state.call_sid)
+
+    def pop(self, call_sid):
+        return self._calls.pop(call_sid, None)
+
+    def expired(self, cutoff):
+        expired = []
+        for call_sid, state in self._calls.items():
+            if state.last_active > cutoff:
+                break
+            expired.append(call_sid)
+        return expired
+
+    def oldest(self, count):
+        return [call_sid for call_sid, _ in zip(self._calls, range(count))]
+
+    def call_sids(self):
+        return list(self._calls)
+
+    def count(self):
+        return len(self._calls)
+
+    def close(self):
+        pass
+
+
+class SQLiteCallStateBackend:
+    """
+    Call state shared between worker processes through one SQLite file.
+
+    The database runs in WAL mode so readers in other workers never block on
+    a writer, and each call is a single row holding its JSON-encoded state.
+    Its methods block on the database, so CallStateStore runs them on its
+    own thread.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS call_state ("
+            "call_sid TEXT PRIMARY KEY, data TEXT NOT NULL, last_active REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS call_state_last_active ON call_state (last_active)")
+
+    def load(self, call_sid):
+        row = self._db.execute(
+            "SELECT data, last_active FROM call_state WHERE call_sid = ?", (call_sid,)
+        ).fetchone()
+        if row is None:
+            return None
+        return CallState.from_json(call_sid, row[0], row[1])
+
+    def store(self, state):
+        self._db.execute(
+            "INSERT OR REPLACE INTO call_state (call_sid, data, last_active) VALUES (?, ?, ?)",
+            (state.call_sid, state.to_json(), state.last_active)
+        )
+
+    def pop(self, call_sid):
+        row = self._db.execute(
+            "DELETE FROM call_state WHERE call_sid = ? RETURNING data, last_active", (call_sid,)
+        ).fetchone()
+        if row is None:
+            return None
+        return CallState.from_json(call_sid, row[0], row[1])
+
+    def expired(self, cutoff):
+        rows = self._db.execute(
+            "SELECT call_sid FROM call_state WHERE last_active <= ? ORDER BY last_active", (cutoff,)
+        )
+        return [row[0] for row in rows]
+
+    def oldest(self, count):
+        rows = self._db.execute(
+            "SELECT call_sid FROM call_state ORDER BY last_active LIMIT ?", (count,)
+        )
+        return [row[0] for row in rows]
+
+    def call_sids(self):
+        return [row[0] for row in self._db.execute("SELECT call_sid FROM call_state")]
+
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM call_state").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def create_backend(url):
+    """Build a backend from a CALL_STATE_BACKEND value: 'memory' or 'sqlite:///path/to.db'."""
+    if url in ("", "memory"):
+        return MemoryCallStateBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteCallStateBackend(url[len("sqlite:///"):])
+    raise ValueError(f"Unknown call state backend: {url}")
+
+
+class CallStateStore:
+    """
+    Per-call state with TTL and LRU eviction on top of a pluggable backend.
+
+    A call is evicted once it has been idle for ttl seconds, when the store
+    grows past max_calls (least recently used first), or explicitly through
+    evict() when the call ends. Eviction hooks get the evicted state, so they
+    can still flush the call's transcript.
+
+    Handlers await get() for a call's state, change it, and await save() to
+    write it back; with the in-memory backend save() only refreshes the LRU
+    position, with a shared backend it is what makes the turn visible to
+    other workers. Shared backends are only ever touched from one worker
+    thread, so a busy database never stalls the event loop.
+
+    Only the worker whose evict() removes a call from a shared backend gets
+    its state. Every other worker that handled the call notices it is gone
+    on its next sweep and runs the hooks with state None, so each can let go
+    of what it holds for the call.
+    """
+
+    def __init__(self, backend=None, ttl=900.0, max_calls=1000, sweep_interval=30.0):
+        self.backend = backend if backend is not None else MemoryCallStateBackend()
+        self.ttl = ttl
+        self.max_calls = max_calls
+        self.sweep_interval = sweep_interval
+        self.evictions = 0
+        self._hooks = []
+        self._task = None
+        # Calls this worker has handled, to notice when another worker evicts them
+        self._local = set()
+        self._executor = None
+        if self.backend.shared:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="call-state")
+
+    def on_evict(self, hook):
+        """Register hook(call_sid, state) to run when a call is evicted."""
+        self._hooks.append(hook)
+        return hook
+
+    async def get(self, call_sid):
+        """Return the call's state, creating it if needed, and mark it active."""
+        state, overflow = await self._run_backend(self._load_or_create, call_sid)
+        self._local.add(call_sid)
+        for oldest in overflow:
+            await self.evict(oldest)
+        return state
+
+    async def save(self, state):
+        """Write a call's state back to the backend."""
+        state.last_active = time.time()
+        self._local.add(state.call_sid)
+        await self._run_backend(self.backend.store, state)
+
+    async def reset(self, call_sid):
+        """Start a call with fresh state, evicting anything left under the same id."""
+        await self.evict(call_sid)
+        return await self.get(call_sid)
+
+    async def evict(self, call_sid):
+        state = await self._run_backend(self.backend.pop, call_sid)
+        self._local.discard(call_sid)
+        if state is not None:
+            self.evictions += 1
+            self._run_hooks(call_sid, state)
+
+    async def sweep(self):
+        """Evict every call idle for longer than the TTL, and release calls evicted by other workers."""
+        for call_sid in await self._run_backend(self.backend.expired, time.time() - self.ttl):
+            await self.evict(call_sid)
+        if self.backend.shared and self._local:
+            live = set(await self._run_backend(self.backend.call_sids))
+            for call_sid in self._local - live:
+                self._local.discard(call_sid)
+                self._run_hooks(call_sid, None)
+
+    async def stats(self):
+        return {"calls": await self._run_backend(self.backend.count), "evictions": self.evictions}
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop sweeping. Calls held only in this process are evicted; a shared
+        backend keeps them for the other workers.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if not self.backend.shared:
+            for call_sid in self.backend.call_sids():
+                await self.evict(call_sid)
+        await self._run_backend(self.backend.close)
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _load_or_create(self, call_sid):
+        state = self.backend.load(call_sid)
+        if state is not None:
+            state.last_active = time.time()
+            return state, ()
+        state = CallState(call_sid)
+        self.backend.store(state)
+        overflow = self.backend.count() - self.max_calls
+        return state, self.backend.oldest(overflow) if overflow > 0 else ()
+
+    async def _run_backend(self, method, *args):
+        if self._executor is None:
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    def _run_hooks(self, call_sid, state):
+        for hook in self._hooks:
+            try:
+                hook(call_sid, state)
+            except Exception as e:
+                print(f"Error in eviction hook for call {call_sid}: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Error sweeping call state: {e}")
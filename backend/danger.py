@@ -0,0 +1,198 @@
+import collections
+import functools
+import json
+import re
+
+# Code words used when the caller has none of their own
+DEFAULT_CODE_WORDS = ("pineapple",)
+# Words that flag a caller's message as worrying without raising an alert
+CONCERN_WORDS = ("help", "emergency", "urgent", "scared", "afraid")
+
+_WORD = re.compile(r"[a-z0-9']+")
+_LEADING_WORD = re.compile(r"\w")
+_TRAILING_WORD = re.compile(r"\w+$")
+
+Detection = collections.namedtuple("Detection", "code_word concerns")
+NO_DETECTION = Detection(None, ())
+
+
+def _phrase_pattern(phrase):
+    """Regex for a phrase, allowing any whitespace or hyphens between its words."""
+    return r"[\s\-]+".join(re.escape(word) for word in phrase.split())
+
+
+def _alternation(phrases):
+    """Regex alternation of phrases, longest first so a phrase wins over a word it starts with."""
+    return "|".join(_phrase_pattern(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+
+
+def _normalize(phrase):
+    return " ".join(phrase.lower().replace("-", " ").split())
+
+
+def _within_one_edit(a, b):
+    """Whether a and b differ by at most one insertion, deletion, substitution or transposition."""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    return a[i + 1:] == b[i + 1:] or (
+        i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+    )
+
+
+class DangerDetector:
+    """
+    Finds code words and concern words in a transcript in one pass.
+
+    All phrases are compiled into a single case-insensitive regex, matched on
+    word boundaries so "help" no longer fires on "helpful". Single-word code
+    words of at least fuzzy_min_length letters also match a word one typo
+    away that starts with the same letter, and an exact split ("pine
+    apple"), since speech recognition mangles unusual words. A code word
+    raises an emergency, so shorter code words and anything looser ("set a
+    timer" for "tiger", "a fine apple" for "pineapple") are too easy to hit
+    in ordinary speech. Concern words only match exactly.
+
+    Build detectors with detector_for(), which compiles each distinct set of
+    code words once.
+    """
+
+    def __init__(self, code_words=DEFAULT_CODE_WORDS, concern_words=CONCERN_WORDS, fuzzy_min_length=8):
+        self.code_words = tuple(_normalize(word) for word in code_words if word.strip())
+        self.concern_words = tuple(_normalize(word) for word in concern_words if word.strip())
+        self.max_length = max(map(len, self.code_words), default=0)
+        groups = []
+        if self.code_words:
+            groups.append(f"(?P<code>{_alternation(self.code_words)})")
+        if self.concern_words:
+            groups.append(f"(?P<concern>{_alternation(self.concern_words)})")
+        self._pattern = re.compile(rf"\b(?:{'|'.join(groups)})\b", re.IGNORECASE) if groups else None
+        self._fuzzy = {}
+        for word in self.code_words:
+            if " " not in word and len(word) >= fuzzy_min_length:
+                self._fuzzy.setdefault(len(word), []).append(word)
+        # Lengths a word can have and still be one edit from a fuzzy code word
+        self._fuzzy_lengths = {length + offset for length in self._fuzzy for offset in (-1, 0, 1)}
+
+    def scan(self, text):
+        """Return the code word and concern words found in text."""
+        if self._pattern is None or not text:
+            return NO_DETECTION
+        code_word = None
+        concerns = []
+        for match in self._pattern.finditer(text):
+            if match.lastgroup == "code":
+                if code_word is None:
+                    code_word = _normalize(match.group())
+            elif _normalize(match.group()) not in concerns:
+                concerns.append(_normalize(match.group()))
+        if code_word is None and self._fuzzy:
+            code_word = self._fuzzy_code_word(text)
+        if code_word is None and not concerns:
+            return NO_DETECTION
+        return Detection(code_word, tuple(concerns))
+
+    def code_word(self, text):
+        """Return the first code word in text, or None."""
+        return self.scan(text).code_word
+
+    def _fuzzy_code_word(self, text):
+        words = _WORD.findall(text.lower())
+        for word in words:
+            if len(word) not in self._fuzzy_lengths:
+                continue
+            for length in (len(word) - 1, len(word), len(word) + 1):
+                for code_word in self._fuzzy.get(length, ()):
+                    if word[0] == code_word[0] and _within_one_edit(word, code_word):
+                        return code_word
+        # A code word split in two only counts when it is spelled exactly
+        for first, second in zip(words, words[1:]):
+            if first + second in self._fuzzy.get(len(first) + len(second), ()):
+                return first + second
+        return None
+
+
+class StreamingMatcher:
+    """
+    Watches a transcript that arrives in deltas for a code word.
+
+    Only a rolling suffix of the current utterance is kept: enough to still
+    hold a code word that straddles two deltas, split in two or one edit
+    longer, so each delta costs the same to check however long the
+    utterance gets. The word at the end of the text may still be growing
+    ("tiger" can become "tigers"), so it is only checked once a later delta
+    shows where it ends; the completed transcript settles the last word.
+
+    Deltas are fed with their transcription item's id, and a new item, or
+    reset(), starts from an empty text, so the end of one utterance never
+    runs into the start of the next. Once a code word has been found, feed()
+    returns None until then.
+    """
+
+    __slots__ = ("detector", "window", "item_id", "tail", "matched")
+
+    def __init__(self, detector, window=None):
+        self.detector = detector
+        self.window = window or detector.max_length * 2 + 8
+        self.reset()
+
+    def reset(self, item_id=None):
+        """Forget the current utterance."""
+        self.item_id = item_id
+        self.tail = ""
+        self.matched = None
+
+    def feed(self, delta, item_id=None):
+        """Add a delta and return the code word if it just completed one."""
+        if item_id != self.item_id:
+            self.reset(item_id)
+        if self.matched is not None or not delta:
+            return None
+        text = self.tail + delta
+        trailing = _TRAILING_WORD.search(text)
+        complete = text[:trailing.start()] if trailing else text
+        self.matched = self.detector.code_word(complete) if complete else None
+        self.tail = _suffix(text, self.window)
+        return self.matched
+
+
+def _suffix(text, length):
+    """The last length characters of text, reaching back to the start of a word they would cut into."""
+    start = len(text) - length
+    if start <= 0:
+        return text
+    # A cut-off word's ending would otherwise read as a word of its own ("spineapple")
+    cut = _TRAILING_WORD.search(text, 0, start)
+    if cut and _LEADING_WORD.match(text, start):
+        start = cut.start()
+    return text[start:]
+
+
+@functools.lru_cache(maxsize=256)
+def _detector(code_words):
+    return DangerDetector(code_words or DEFAULT_CODE_WORDS)
+
+
+def detector_for(code_words=()):
+    """The detector for a caller's code words (the defaults if they have none)."""
+    return _detector(tuple(sorted({_normalize(word) for word in code_words if word.strip()})))
+
+
+def load_code_words(path):
+    """
+    Read users from a JSON list of User documents and return their code
+    words by phone number, for callers that have set any.
+    """
+    from models import User
+
+    with open(path) as f:
+        users = [User.model_validate(entry) for entry in json.load(f)]
+    return {user.phone_number: tuple(user.code_words) for user in users if user.code_words}
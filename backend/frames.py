@@ -0,0 +1,72 @@
+import collections
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+Codec = collections.namedtuple("Codec", ("name", "loads", "dumps"))
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def get_codec(name="auto"):
+    """
+    JSON codec for WebSocket frames: 'orjson', 'msgspec', 'json' or 'auto'.
+
+    'auto' picks the fastest one installed. loads() takes str or bytes and
+    dumps() always returns str, since both Twilio and the OpenAI realtime API
+    expect text frames.
+    """
+    if name == "auto":
+        name = "orjson" if orjson is not None else "msgspec" if msgspec is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("JSON codec 'orjson' is not installed")
+        return Codec("orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode())
+    if name == "msgspec":
+        if msgspec is None:
+            raise ValueError("JSON codec 'msgspec' is not installed")
+        decoder = msgspec.json.Decoder()
+        encoder = msgspec.json.Encoder()
+        return Codec("msgspec", decoder.decode, lambda obj: encoder.encode(obj).decode())
+    if name == "json":
+        return Codec("json", json.loads, _stdlib_dumps)
+    raise ValueError(f"Unknown JSON codec: {name}")
+
+
+def audio_append(payload):
+    """input_audio_buffer.append event for a base64 audio payload."""
+    return '{"type":"input_audio_buffer.append","audio":"' + payload + '"}'
+
+
+class TwilioFrames:
+    """
+    Pre-built outbound frames for one Twilio media stream.
+
+    The streamSid is encoded once; media() then only splices the payload
+    into the template. Payloads must be base64, which never needs escaping.
+    """
+
+    __slots__ = ("stream_sid", "clear", "_media", "_mark")
+
+    def __init__(self, stream_sid):
+        sid = json.dumps(stream_sid)
+        self.stream_sid = stream_sid
+        self.clear = '{"event":"clear","streamSid":' + sid + '}'
+        self._media = '{"event":"media","streamSid":' + sid + ',"media":{"payload":"'
+        self._mark = '{"event":"mark","streamSid":' + sid + ',"mark":{"name":'
+
+    def media(self, payload):
+        return self._media + payload + '"}}'
+
+    def mark(self, name):
+        return self._mark + json.dumps(name) + '}}'
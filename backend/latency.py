@@ -0,0 +1,73 @@
+import collections
+import contextlib
+import time
+
+
+class LatencyStats:
+    """
+    Rolling latency samples per named stage.
+
+    Only the last window samples of each stage are kept, so percentiles
+    follow recent traffic and memory stays bounded.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = {}
+        self._counts = collections.Counter()
+
+    def record(self, name, seconds):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = collections.deque(maxlen=self.window)
+        samples.append(seconds)
+        self._counts[name] += 1
+
+    def stats(self):
+        """Count plus p50/p95/max in milliseconds for every stage."""
+        result = {}
+        for name, samples in self._samples.items():
+            ordered = sorted(samples)
+            result[name] = {
+                "count": self._counts[name],
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2)
+            }
+        return result
+
+
+class TurnTimer:
+    """
+    Times the stages of one conversational turn into a LatencyStats.
+
+    stage() measures a block on its own; mark() records the time elapsed
+    since the turn started, for points on the critical path such as the
+    response being returned.
+    """
+
+    __slots__ = ("stats", "prefix", "started", "timings")
+
+    def __init__(self, stats, prefix="turn"):
+        self.stats = stats
+        self.prefix = prefix
+        self.started = time.perf_counter()
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def mark(self, name):
+        self._record(name, time.perf_counter() - self.started)
+
+    def summary(self):
+        return " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.timings.items())
+
+    def _record(self, name, seconds):
+        self.timings[name] = seconds
+        self.stats.record(f"{self.prefix}.{name}", seconds)
@@ -0,0 +1,95 @@
+import asyncio
+import collections
+import json
+
+
+class _Subscriber:
+    __slots__ = ("call_sid", "queue", "dropped")
+
+    def __init__(self, call_sid, size):
+        self.call_sid = call_sid
+        self.queue = asyncio.Queue(size)
+        self.dropped = 0
+
+    def put(self, event):
+        if self.queue.full():
+            # A slow reader loses its oldest events rather than holding up the publisher
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class LiveHub:
+    """
+    In-process pub/sub for live transcripts and insights, by call.
+
+    publish() takes a webhook batch ({"transcriptions": [...],
+    "insights": [...]}) and formats each item once as a Server-Sent Event,
+    numbered with a hub-wide id. Subscribers follow one call, or every call
+    with call_sid None, through a bounded queue. The last replay events of
+    each call (and of all calls together) are kept in ring buffers, so a
+    subscriber that connects late, or reconnects with Last-Event-ID, first
+    gets what it missed. Buffers are kept for the max_calls most recently
+    active calls.
+    """
+
+    def __init__(self, replay=100, max_calls=1000, queue_size=256, dumps=json.dumps):
+        self.replay = replay
+        self.max_calls = max_calls
+        self.queue_size = queue_size
+        self.dumps = dumps
+        self.published = 0
+        self._last_id = 0
+        self._recent = collections.deque(maxlen=replay)
+        self._calls = collections.OrderedDict()
+        self._subscribers = {}
+
+    def publish(self, batch):
+        for kind, event_type in (("transcriptions", "transcription"), ("insights", "insight")):
+            for item in batch.get(kind, ()):
+                self._publish(item.get("call_sid"), event_type, item)
+
+    def subscribe(self, call_sid=None, last_id=0):
+        """Register a subscriber, preloaded with the buffered events after last_id."""
+        subscriber = _Subscriber(call_sid, self.queue_size)
+        buffered = self._recent if call_sid is None else self._calls.get(call_sid, ())
+        for event_id, event in buffered:
+            if event_id > last_id:
+                subscriber.put(event)
+        self._subscribers.setdefault(call_sid, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscribers = self._subscribers.get(subscriber.call_sid)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.call_sid]
+
+    def stats(self):
+        subscribers = [subscriber for group in self._subscribers.values() for subscriber in group]
+        return {
+            "published": self.published,
+            "calls": len(self._calls),
+            "subscribers": len(subscribers),
+            "dropped": sum(subscriber.dropped for subscriber in subscribers)
+        }
+
+    def _publish(self, call_sid, event_type, item):
+        self._last_id += 1
+        self.published += 1
+        entry = (self._last_id, f"id: {self._last_id}\nevent: {event_type}\ndata: {self.dumps(item)}\n\n")
+        self._recent.append(entry)
+        if call_sid is not None:
+            buffer = self._calls.get(call_sid)
+            if buffer is None:
+                buffer = self._calls[call_sid] = collections.deque(maxlen=self.replay)
+                if len(self._calls) > self.max_calls:
+                    self._calls.popitem(last=False)
+            else:
+                self._calls.move_to_end(call_sid)
+            buffer.append(entry)
+            for subscriber in self._subscribers.get(call_sid, ()):
+                subscriber.put(entry[1])
+        for subscriber in self._subscribers.get(None, ()):
+            subscriber.put(entry[1])
@@ -1,25 +1,71 @@
 # Do not forget to update the new ngruk thingy
 import os
 import json
-import base64
 import asyncio
 import websockets
-import httpx
 import datetime
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.websockets import WebSocketDisconnect
 from twilio.twiml.voice_response import VoiceResponse, Connect, Say, Stream, Gather, Redirect
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
+from webhooks import WebhookDispatcher, PartialDebouncer, FileSink, CallbackSink
+from transcripts import TranscriptWriter
+from call_state import Turn, CallStateStore, create_backend
+from openai_client import OpenAIClient, split_first_sentence
+from latency import LatencyStats, TurnTimer
+from audio_taps import AudioTaps
+from frames import get_codec, audio_append
+from realtime import EventRegistry, MediaStreamSession, StreamRegistry, TRANSCRIPT_DELTA_EVENTS, transcript_delta
+from vad import VoiceGate, NUMPY_AVAILABLE
+from realtime_pool import RealtimePool
+from live import LiveHub
+from admission import AdmissionLimiter
+from danger import detector_for
 
 load_dotenv()
 
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY_1')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
 PORT = int(os.getenv('PORT', 5050))
 FRONTEND_WEBHOOK_URL = os.getenv('FRONTEND_WEBHOOK_URL', 'http://localhost:3000/api/webhook')
+WEBHOOK_URLS = [url.strip() for url in os.getenv('WEBHOOK_URLS', FRONTEND_WEBHOOK_URL).split(',') if url.strip()] or [FRONTEND_WEBHOOK_URL]
+WEBHOOK_FILE = os.getenv('WEBHOOK_FILE')
 WEBHOOK_DEBUG = os.getenv('WEBHOOK_DEBUG', 'true').lower() == 'true'
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 20))
+WEBHOOK_FLUSH_INTERVAL = float(os.getenv('WEBHOOK_FLUSH_INTERVAL', 0.25))
+WEBHOOK_MAX_QUEUE = int(os.getenv('WEBHOOK_MAX_QUEUE', 200))
+WEBHOOK_FAILURE_THRESHOLD = int(os.getenv('WEBHOOK_FAILURE_THRESHOLD', 5))
+WEBHOOK_RESET_TIMEOUT = float(os.getenv('WEBHOOK_RESET_TIMEOUT', 30))
+LIVE_REPLAY_EVENTS = int(os.getenv('LIVE_REPLAY_EVENTS', 100))
+LIVE_KEEPALIVE = float(os.getenv('LIVE_KEEPALIVE', 15))
+PARTIAL_DEBOUNCE_MS = int(os.getenv('PARTIAL_DEBOUNCE_MS', 150))
+TRANSCRIPT_FSYNC_INTERVAL = float(os.getenv('TRANSCRIPT_FSYNC_INTERVAL', 1.0))
+CALL_STATE_TTL = float(os.getenv('CALL_STATE_TTL', 900))
+CALL_STATE_MAX_CALLS = int(os.getenv('CALL_STATE_MAX_CALLS', 1000))
+CALL_STATE_BACKEND = os.getenv('CALL_STATE_BACKEND', 'memory')
+WORKERS = int(os.getenv('WORKERS', 1))
+SHOW_TURN_TIMINGS = os.getenv('SHOW_TURN_TIMINGS', 'false').lower() == 'true'
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto')
+MARK_INTERVAL_FRAMES = int(os.getenv('MARK_INTERVAL_FRAMES', 5))
+PACE_AUDIO = os.getenv('PACE_AUDIO', 'false').lower() == 'true'
+PACE_LEAD_MS = float(os.getenv('PACE_LEAD_MS', 200))
+INBOUND_VAD = os.getenv('INBOUND_VAD', 'false').lower() == 'true'
+VAD_THRESHOLD_DBFS = float(os.getenv('VAD_THRESHOLD_DBFS', -45))
+VAD_HANGOVER_MS = float(os.getenv('VAD_HANGOVER_MS', 800))
+VAD_PREROLL_MS = float(os.getenv('VAD_PREROLL_MS', 100))
+REALTIME_POOL_SIZE = int(os.getenv('REALTIME_POOL_SIZE', 0))
+REALTIME_POOL_MAX_IDLE = float(os.getenv('REALTIME_POOL_MAX_IDLE', 300))
+MAX_REALTIME_SESSIONS = int(os.getenv('MAX_REALTIME_SESSIONS', 20))
+REALTIME_ADMISSION_WAIT = float(os.getenv('REALTIME_ADMISSION_WAIT', 2))
+MAX_CHAT_REQUESTS = int(os.getenv('MAX_CHAT_REQUESTS', 50))
+CHAT_ADMISSION_WAIT = float(os.getenv('CHAT_ADMISSION_WAIT', 3))
+TRANSCRIPTION_MODEL = os.getenv('TRANSCRIPTION_MODEL', 'gpt-4o-transcribe')
 
 SYSTEM_MESSAGE = (
     "You are a human with a natural, realistic voice, designed to provide reassurance and deterrence in high-risk situations. "
@@ -35,24 +81,93 @@ SYSTEM_MESSAGE = (
     "\n9. If unsure of the context, default to casual but attentive engagement, encouraging the user to speak freely. "
     "\n10. Prioritize clarity and authenticity—your goal is to sound indistinguishable from a real person while ensuring safety."
 )
+SYSTEM_PROMPT = {"role": "system", "content": SYSTEM_MESSAGE}
+BUSY_REPLY = "Sorry, give me just a second. Could you say that again?"
+API_ERROR_REPLY = "I'm sorry, I'm having trouble connecting to my brain right now. Could you try again?"
+ERROR_REPLY = "I apologize, but I encountered an error processing your request. Let's try again."
+FALLBACK_REPLIES = frozenset((BUSY_REPLY, API_ERROR_REPLY, ERROR_REPLY))
 # Available voices: 'alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer', 'sage'
 VOICE = 'sage'
-LOG_EVENT_TYPES = [
+LOG_EVENT_TYPES = frozenset([
     'error', 'response.content.done', 'rate_limits.updated',
     'response.done', 'input_audio_buffer.committed',
     'input_audio_buffer.speech_stopped', 'input_audio_buffer.speech_started',
     'session.created',
     'response.audio_transcript.done',
     'conversation.item.input_audio_transcription.completed',
-]
+])
 SHOW_TIMING_MATH = False
-CALL_DURATION_LIMIT = 30  # 30 seconds (change to 240 for 4 minutes)
+CALL_DURATION_LIMIT = int(os.getenv('CALL_DURATION_LIMIT', 240))  # 4 minutes of natural conversation mode (0 for no limit)
 
 # Store conversation history and transcripts
-conversation_history = {}
-call_transcripts = {}
+call_states = CallStateStore(
+    create_backend(CALL_STATE_BACKEND),
+    ttl=CALL_STATE_TTL,
+    max_calls=CALL_STATE_MAX_CALLS
+)
+# Streamed AI responses still generating after their first sentence was said, by call.
+# These only live in this worker, and Twilio can send /continue-response to any worker.
+pending_replies = {}
+if STREAM_RESPONSES and (WORKERS > 1 or call_states.backend.shared):
+    print("Warning: STREAM_RESPONSES is turned off because calls are shared between workers.")
+    STREAM_RESPONSES = False
 
-app = FastAPI()
+webhook_dispatcher = WebhookDispatcher(
+    WEBHOOK_URLS,
+    max_batch=WEBHOOK_BATCH_SIZE,
+    flush_interval=WEBHOOK_FLUSH_INTERVAL,
+    max_queue=WEBHOOK_MAX_QUEUE,
+    failure_threshold=WEBHOOK_FAILURE_THRESHOLD,
+    reset_timeout=WEBHOOK_RESET_TIMEOUT,
+    debug=WEBHOOK_DEBUG
+)
+if WEBHOOK_FILE:
+    webhook_dispatcher.add_sink(FileSink(WEBHOOK_FILE))
+openai_client = OpenAIClient(OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=OPENAI_MAX_RETRIES)
+transcript_writer = TranscriptWriter(
+    'transcripts',
+    fsync_interval=TRANSCRIPT_FSYNC_INTERVAL,
+    part=os.getpid() if call_states.backend.shared else None
+)
+turn_latency = LatencyStats()
+# Side effects still running after their turn's TwiML was returned
+background_tasks = set()
+audio_taps = AudioTaps()
+media_streams = StreamRegistry()
+codec = get_codec(JSON_CODEC)
+live_hub = LiveHub(replay=LIVE_REPLAY_EVENTS, dumps=codec.dumps)
+webhook_dispatcher.add_sink(CallbackSink(live_hub.publish, name="live"))
+
+async def connect_realtime():
+    return await websockets.connect(
+        'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-12-17',
+        extra_headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "OpenAI-Beta": "realtime=v1"
+        }
+    )
+
+realtime_pool = RealtimePool(connect_realtime, size=REALTIME_POOL_SIZE, max_idle=REALTIME_POOL_MAX_IDLE)
+realtime_admission = AdmissionLimiter(MAX_REALTIME_SESSIONS, max_wait=REALTIME_ADMISSION_WAIT)
+chat_admission = AdmissionLimiter(MAX_CHAT_REQUESTS, max_wait=CHAT_ADMISSION_WAIT)
+
+@asynccontextmanager
+async def lifespan(app):
+    await webhook_dispatcher.start()
+    await openai_client.start()
+    transcript_writer.start()
+    await call_states.start()
+    await realtime_pool.start()
+    yield
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await realtime_pool.stop()
+    await call_states.stop()
+    await webhook_dispatcher.stop()
+    await openai_client.stop()
+    await asyncio.to_thread(transcript_writer.stop)
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -65,60 +180,96 @@ app.add_middleware(
 if not OPENAI_API_KEY:
     raise ValueError('Missing the OpenAI API key. Please set it in the .env file.')
 
+if INBOUND_VAD and not NUMPY_AVAILABLE:
+    print("Warning: INBOUND_VAD needs NumPy, which is not installed; sending all caller audio.")
+    INBOUND_VAD = False
+
 async def send_to_webhook(call_sid, message_type="user", content="", speaker="Caller", confidence=None, is_partial=False):
     """
-    Send transcription data to the frontend webhook.
+    Queue transcription data for the frontend webhook.
     """
-    try:
-        unique_id = int(datetime.datetime.now().timestamp() * 1000)
-        data = {
-            "transcriptions": [
-                {
-                    "id": unique_id,
-                    "speaker": "Caller" if message_type == "user" else "You",
-                    "text": content,
-                    "time": datetime.datetime.now().strftime("%H:%M:%S"),
-                    "sentiment": "neutral",
-                    "confidence": confidence,
-                    "call_sid": call_sid,
-                    "is_partial": is_partial
-                }
-            ],
-            "insights": []
-        }
-        if message_type == "user" and any(keyword in content.lower() for keyword in ["help", "emergency", "urgent", "scared", "afraid"]):
-            data["insights"].append({
-                "id": unique_id + 1,
-                "type": "warning",
-                "text": f"Detected concern in caller's message: '{content}'"
-            })
-        if WEBHOOK_DEBUG:
-            print(f"Sending to webhook: {json.dumps(data, indent=2)}")
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                FRONTEND_WEBHOOK_URL,
-                json=data,
-                headers={"Content-Type": "application/json"}
-            )
-            if response.status_code == 200:
-                if WEBHOOK_DEBUG:
-                    print(f"Successfully sent to webhook: {response.text}")
-            else:
-                print(f"Error sending to webhook: {response.status_code} - {response.text}")
-    except Exception as e:
-        print(f"Exception when sending to webhook: {e}")
+    unique_id = int(datetime.datetime.now().timestamp() * 1000)
+    transcription = {
+        "id": unique_id,
+        "speaker": "Caller" if message_type == "user" else "You",
+        "text": content,
+        "time": datetime.datetime.now().strftime("%H:%M:%S"),
+        "sentiment": "neutral",
+        "confidence": confidence,
+        "call_sid": call_sid,
+        "is_partial": is_partial
+    }
+    insights = []
+    if message_type == "user" and detector_for().scan(content).concerns:
+        insights.append({
+            "id": unique_id + 1,
+            "type": "warning",
+            "text": f"Detected concern in caller's message: '{content}'",
+            "call_sid": call_sid
+        })
+    webhook_dispatcher.submit(call_sid, [transcription], insights)
+
+async def send_partial_to_webhook(call_sid, message_type, content):
+    await send_to_webhook(
+        call_sid=call_sid,
+        message_type=message_type,
+        content=content,
+        speaker="Caller" if message_type == "user" else "You",
+        confidence=None,
+        is_partial=True
+    )
+
+partial_debouncer = PartialDebouncer(send_partial_to_webhook, interval=PARTIAL_DEBOUNCE_MS / 1000)
 
 @app.get("/", response_class=JSONResponse)
 async def index_page():
     return {"message": "Twilio Media Stream Server is running!"}
 
+@app.get("/metrics", response_class=JSONResponse)
+async def metrics():
+    """Expose internal queue depths and counters."""
+    return {
+        "webhooks": webhook_dispatcher.stats(),
+        "calls": await call_states.stats(),
+        "openai": openai_client.stats(),
+        "turns": turn_latency.stats(),
+        "background_tasks": len(background_tasks),
+        "media_streams": len(media_streams),
+        "realtime_pool": realtime_pool.stats(),
+        "admission": {"realtime": realtime_admission.stats(), "chat": chat_admission.stats()},
+        "live": live_hub.stats()
+    }
+
+@app.get("/live")
+async def live_events(request: Request, call_sid: str = None):
+    """Stream transcripts and insights as Server-Sent Events, for one call or all of them."""
+    last_id = request.headers.get('last-event-id', '')
+    subscriber = live_hub.subscribe(call_sid, int(last_id) if last_id.isdigit() else 0)
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscriber.queue.get(), LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            live_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/live")
+async def publish_live_events(request: Request):
+    """Publish a webhook-format batch, such as a dashboard test message, to /live subscribers."""
+    live_hub.publish(await request.json())
+    return {"success": True}
+
 @app.api_route("/incoming-call", methods=["GET", "POST"])
 async def handle_incoming_call(request: Request):
     """Initial entry point for incoming calls."""
     form_data = await request.form()
     call_sid = form_data.get('CallSid', 'unknown')
-    conversation_history[call_sid] = []
-    call_transcripts[call_sid] = []
+    await call_states.reset(call_sid)
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"New call received: {call_sid} at {timestamp}")
     response = VoiceResponse()
@@ -151,40 +302,60 @@ async def start_gather(request: Request):
     response.redirect('/start-gather')
     return HTMLResponse(content=str(response), media_type="application/xml")
 
-async def get_ai_response(user_query, call_sid):
-    """Get a response from the OpenAI API."""
-    messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
-    history = conversation_history.get(call_sid, [])
-    for entry in history[-10:]:
-        if entry.startswith("User: "):
-            messages.append({"role": "user", "content": entry[6:]})
-        elif entry.startswith("AI: "):
-            messages.append({"role": "assistant", "content": entry[4:]})
-    messages.append({"role": "user", "content": user_query})
+async def get_ai_response(state):
+    """Get a response from the OpenAI API for the call's latest turn."""
+    messages = [SYSTEM_PROMPT, *state.messages()]
+    if not await chat_admission.acquire():
+        print("Chat completion limit reached, answering with the busy reply")
+        return BUSY_REPLY
     try:
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
         data = {
             "model": "gpt-4o",
             "messages": messages,
             "max_tokens": 250,
             "temperature": 0.7,
         }
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, headers=headers, json=data)
+        response = await openai_client.post("/chat/completions", data)
         if response.status_code == 200:
             response_data = response.json()
             ai_message = response_data["choices"][0]["message"]["content"]
             return ai_message
         else:
             print(f"Error from OpenAI API: {response.status_code} - {response.text}")
-            return "I'm sorry, I'm having trouble connecting to my brain right now. Could you try again?"
+            return API_ERROR_REPLY
     except Exception as e:
         print(f"Exception when calling OpenAI API: {e}")
-        return "I apologize, but I encountered an error processing your request. Let's try again."
+        return ERROR_REPLY
+    finally:
+        chat_admission.release()
+
+async def stream_ai_response(state):
+    """Yield the OpenAI API's response for the call's latest turn as it is generated."""
+    messages = [SYSTEM_PROMPT, *state.messages()]
+    data = {
+        "model": "gpt-4o",
+        "messages": messages,
+        "max_tokens": 250,
+        "temperature": 0.7,
+    }
+    if not await chat_admission.acquire():
+        print("Chat completion limit reached, answering with the busy reply")
+        yield BUSY_REPLY
+        return
+    produced = False
+    try:
+        async for event in openai_client.stream("/chat/completions", data):
+            choices = event.get("choices")
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if delta:
+                produced = True
+                yield delta
+    except Exception as e:
+        print(f"Exception when streaming from OpenAI API: {e}")
+        if not produced:
+            yield ERROR_REPLY
+    finally:
+        chat_admission.release()
 
 @app.api_route("/process-speech", methods=["GET", "POST"])
 async def process_speech(request: Request):
@@ -193,67 +364,77 @@ async def process_speech(request: Request):
     call_sid = form_data.get('CallSid', 'unknown')
     speech_result = form_data.get('SpeechResult', '')
     confidence = form_data.get('Confidence', '0')
-    if call_sid not in conversation_history:
-        conversation_history[call_sid] = []
-    if call_sid not in call_transcripts:
-        call_transcripts[call_sid] = []
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timer = TurnTimer(turn_latency, "speech")
+    state = await call_states.get(call_sid)
     response = VoiceResponse()
     if speech_result:
         print(f"TRANSCRIPTION - Call {call_sid}:")
         print(f"User said: \"{speech_result}\"")
         print(f"Confidence: {confidence}")
-        conversation_history[call_sid].append(f"User: {speech_result}")
-        call_transcripts[call_sid].append({
-            "role": "user",
-            "content": speech_result,
-            "timestamp": timestamp,
-            "confidence": confidence
-        })
+        # Only the OpenAI call is on the critical path; persisting and
+        # publishing the caller's turn runs alongside it.
+        run_in_background(publish_turn(state, add_turn(state, "user", speech_result, confidence), timer))
         print("\nFull Conversation History:")
-        for entry in conversation_history[call_sid]:
-            print(entry)
+        for turn in state.turns:
+            print(f"{'User' if turn.role == 'user' else 'AI'}: {turn.content}")
         print("")
-        await send_to_webhook(
-            call_sid=call_sid,
-            message_type="user", 
-            content=speech_result, 
-            speaker="Caller", 
-            confidence=confidence
-        )
-        save_conversation_to_file(call_sid)
-        ai_response = await get_ai_response(speech_result, call_sid)
-        conversation_history[call_sid].append(f"AI: {ai_response}")
-        current_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        call_transcripts[call_sid].append({
-            "role": "assistant",
-            "content": ai_response,
-            "timestamp": current_timestamp
-        })
-        await send_to_webhook(
-            call_sid=call_sid,
-            message_type="assistant", 
-            content=ai_response, 
-            speaker="You"
-        )
-        # Use SSML markup so the AI response sounds more natural.
-        response.say(f"<speak>{ai_response}</speak>", voice=VOICE)
+
+        async def finish_reply(ai_response):
+            timer.mark("ai_complete")
+            if ai_response.strip() in FALLBACK_REPLIES:
+                return
+            run_in_background(publish_turn(state, add_turn(state, "assistant", ai_response), timer))
+
+        if STREAM_RESPONSES:
+            # Say the first sentence as soon as it exists and fetch the rest on the redirect
+            first_sentence, reply = await split_first_sentence(stream_ai_response(state), on_complete=finish_reply)
+            timer.mark("ai_first_sentence")
+            response.say(f"<speak>{first_sentence}</speak>", voice=VOICE)
+            if not reply.done():
+                pending_replies[call_sid] = (first_sentence, reply)
+                response.redirect('/continue-response')
+                return twiml_response(response, timer)
+        else:
+            ai_response = await get_ai_response(state)
+            await finish_reply(ai_response)
+            # Use SSML markup so the AI response sounds more natural.
+            response.say(f"<speak>{ai_response}</speak>", voice=VOICE)
     else:
         print(f"No speech detected for call {call_sid}")
-        conversation_history[call_sid].append("User: [No speech detected]")
-        call_transcripts[call_sid].append({
-            "role": "user",
-            "content": "[No speech detected]",
-            "timestamp": timestamp
-        })
-        await send_to_webhook(
-            call_sid=call_sid,
-            message_type="user", 
-            content="[No speech detected]", 
-            speaker="Caller"
-        )
+        run_in_background(publish_turn(state, add_turn(state, "user", "[No speech detected]"), timer))
         response.say("<speak>I didn't understand what you said. Let's try again.</speak>", voice=VOICE)
-    if len(conversation_history[call_sid]) > 10:
+    continue_conversation(response, state)
+    return twiml_response(response, timer)
+
+def twiml_response(response, timer):
+    """Return the turn's TwiML and record how long the caller waited for it."""
+    timer.mark("twiml")
+    if SHOW_TURN_TIMINGS:
+        print(f"Turn timings: {timer.summary()}")
+    return HTMLResponse(content=str(response), media_type="application/xml")
+
+@app.api_route("/continue-response", methods=["GET", "POST"])
+async def continue_response(request: Request):
+    """Say the rest of a streamed AI response once it has finished generating."""
+    form_data = await request.form()
+    call_sid = form_data.get('CallSid', 'unknown')
+    response = VoiceResponse()
+    pending = pending_replies.pop(call_sid, None)
+    if pending:
+        first_sentence, reply = pending
+        try:
+            ai_response = await reply
+            remainder = ai_response.strip()[len(first_sentence):].strip()
+            if remainder:
+                response.say(f"<speak>{remainder}</speak>", voice=VOICE)
+        except Exception as e:
+            print(f"Error finishing streamed response: {e}")
+    continue_conversation(response, await call_states.get(call_sid))
+    return HTMLResponse(content=str(response), media_type="application/xml")
+
+def continue_conversation(response, state):
+    """Loop back to Gather, offering natural conversation mode once the call has enough turns."""
+    if state.turn_count > 10:
         gather = Gather(
             input='dtmf',
             action='/handle-continue-choice',
@@ -266,18 +447,62 @@ async def process_speech(request: Request):
         response.redirect('/start-gather')
     else:
         response.redirect('/start-gather')
-    return HTMLResponse(content=str(response), media_type="application/xml")
+
+def add_turn(state, role, content, confidence=None):
+    """Add a turn to the call's in-memory log, which is all the next prompt needs."""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return state.add_turn(Turn(role, content, timestamp, confidence))
+
+async def persist_turn(state, turn):
+    """Append a turn to the call's transcript file and save the call's state."""
+    transcript_writer.append(state.call_sid, turn.to_dict())
+    await call_states.save(state)
+
+async def record_turn(state, role, content, confidence=None):
+    """Add a turn to the call's log, append it to its transcript file and save the state."""
+    turn = add_turn(state, role, content, confidence)
+    await persist_turn(state, turn)
+    return turn
+
+async def publish_turn(state, turn, timer):
+    """Persist a turn and send it to the webhook, timing each side effect."""
+    with timer.stage(f"{turn.role}_persist"):
+        await persist_turn(state, turn)
+    with timer.stage(f"{turn.role}_webhook"):
+        await send_to_webhook(
+            call_sid=state.call_sid,
+            message_type=turn.role,
+            content=turn.content,
+            speaker="Caller" if turn.role == "user" else "You",
+            confidence=turn.confidence
+        )
+
+def run_in_background(coro):
+    """Run a turn's side effect without holding up its TwiML response."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error in background turn task: {task.exception()}")
 
 def save_conversation_to_file(call_sid):
-    """Save the conversation transcript to a file."""
-    try:
-        os.makedirs('transcripts', exist_ok=True)
-        filename = f"transcripts/call_{call_sid}_{datetime.datetime.now().strftime('%Y%m%d')}.json"
-        with open(filename, 'w') as f:
-            json.dump(call_transcripts.get(call_sid, []), f, indent=2)
-        print(f"Saved transcript to {filename}")
-    except Exception as e:
-        print(f"Error saving transcript: {e}")
+    """Compact the call's appended transcript lines into its JSON transcript file."""
+    transcript_writer.export(call_sid)
+
+@call_states.on_evict
+def flush_call(call_sid, state):
+    """
+    Persist the transcript and push out pending webhooks for an evicted call;
+    state is None when another worker evicted it.
+    """
+    save_conversation_to_file(call_sid)
+    webhook_dispatcher.flush(call_sid)
+    partial_debouncer.discard(call_sid)
+    pending_replies.pop(call_sid, None)
 
 @app.api_route("/handle-continue-choice", methods=["GET", "POST"])
 async def handle_continue_choice(request: Request):
@@ -300,11 +525,21 @@ async def connect_to_ai(request: Request):
     form_data = await request.form()
     call_sid = form_data.get('CallSid', 'unknown')
     response = VoiceResponse()
+    if not realtime_admission.available:
+        # Fast reject: keep the caller in Gather mode rather than queue for a realtime session
+        print(f"Realtime session limit reached, keeping call {call_sid} in Gather mode")
+        realtime_admission.reject()
+        response.say("<speak>Natural conversation mode is busy right now, so let's keep talking like this.</speak>", voice=VOICE)
+        response.redirect('/start-gather')
+        return HTMLResponse(content=str(response), media_type="application/xml")
     response.say("<speak>Connecting you directly to the AI assistant.</speak>", voice=VOICE)
     host = request.url.hostname
     connect = Connect()
     connect.stream(url=f'wss://{host}/media-stream')
     response.append(connect)
+    # Twilio carries on here once the stream ends, e.g. at CALL_DURATION_LIMIT
+    response.say("<speak>Sorry, I've got to go now. Talk to you later!</speak>", voice=VOICE)
+    response.hangup()
     return HTMLResponse(content=str(response), media_type="application/xml")
 
 @app.websocket("/media-stream")
@@ -312,191 +547,195 @@ async def handle_media_stream(websocket: WebSocket):
     """Handle WebSocket connections between Twilio and OpenAI."""
     print("Media stream client connected")
     await websocket.accept()
-    async with websockets.connect(
-        'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-12-17',
-        extra_headers={
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "OpenAI-Beta": "realtime=v1"
-        }
-    ) as openai_ws:
-        await initialize_session(openai_ws)
-        stream_sid = None
-        latest_media_timestamp = 0
-        last_assistant_item = None
-        mark_queue = []
-        response_start_timestamp_twilio = None
-        current_ai_response = ""
-        current_user_input = ""
-        
-        async def receive_from_twilio():
-            nonlocal stream_sid, latest_media_timestamp
-            audio_buffer = bytearray()
-            try:
-                async for message in websocket.iter_text():
-                    data = json.loads(message)
-                    if data['event'] == 'media' and openai_ws.open:
-                        latest_media_timestamp = int(data['media']['timestamp'])
-                        payload = data['media']['payload']
-                        audio_buffer.extend(base64.b64decode(payload))
-                        audio_append = {
-                            "type": "input_audio_buffer.append",
-                            "audio": payload
-                        }
-                        await openai_ws.send(json.dumps(audio_append))
-                    elif data['event'] == 'start':
-                        stream_sid = data['start']['streamSid']
-                        print(f"Incoming stream has started {stream_sid}")
-                        audio_buffer.clear()
-                        latest_media_timestamp = 0
-                    elif data['event'] == 'mark':
-                        if mark_queue:
-                            mark_queue.pop(0)
-                    elif data['event'] == 'stop':
-                        print("Stream ended.")
-                        if stream_sid and stream_sid in call_transcripts:
-                            save_conversation_to_file(stream_sid)
-            except WebSocketDisconnect:
-                print("Client disconnected.")
-                if openai_ws.open:
-                    await openai_ws.close()
-                if stream_sid and stream_sid in call_transcripts:
-                    save_conversation_to_file(stream_sid)
-
-        async def send_to_twilio():
-            nonlocal stream_sid, last_assistant_item, response_start_timestamp_twilio, current_ai_response, current_user_input
-            try:
-                async for openai_message in openai_ws:
-                    response_data = json.loads(openai_message)
-                    if response_data['type'] in LOG_EVENT_TYPES:
-                        print(f"Received event: {response_data['type']}", response_data)
-                        if response_data['type'] == 'conversation.item.input_audio_transcription.completed':
-                            if 'transcript' in response_data:
-                                user_input = response_data['transcript']
-                                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                if stream_sid and stream_sid in call_transcripts:
-                                    call_transcripts[stream_sid].append({
-                                        "role": "user",
-                                        "content": user_input,
-                                        "timestamp": timestamp
-                                    })
-                                    print(f"User transcript: {user_input}")
-                                    await send_to_webhook(
-                                        call_sid=stream_sid,
-                                        message_type="user",
-                                        content=user_input,
-                                        speaker="Caller"
-                                    )
-                        elif response_data['type'] == 'response.audio_transcript.done':
-                            if 'transcript' in response_data:
-                                ai_response = response_data['transcript']
-                                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                if stream_sid and stream_sid in call_transcripts:
-                                    call_transcripts[stream_sid].append({
-                                        "role": "assistant",
-                                        "content": ai_response,
-                                        "timestamp": timestamp
-                                    })
-                                    print(f"AI transcript: {ai_response}")
-                                    await send_to_webhook(
-                                        call_sid=stream_sid,
-                                        message_type="assistant",
-                                        content=ai_response,
-                                        speaker="You"
-                                    )
-                    if response_data.get('type') == 'response.content.delta' and 'delta' in response_data:
-                        current_ai_response += response_data['delta'].get('text', '')
-                        print(f"AI response text: {current_ai_response}")
-                        if len(current_ai_response) > 5 and stream_sid:
-                            await send_to_webhook(
-                                call_sid=stream_sid,
-                                message_type="assistant",
-                                content=current_ai_response,
-                                speaker="You",
-                                confidence=None,
-                                is_partial=True
-                            )
-                    if response_data.get('type') == 'response.audio.delta' and 'delta' in response_data:
-                        audio_payload = base64.b64encode(base64.b64decode(response_data['delta'])).decode('utf-8')
-                        audio_delta = {
-                            "event": "media",
-                            "streamSid": stream_sid,
-                            "media": {
-                                "payload": audio_payload
-                            }
-                        }
-                        await websocket.send_json(audio_delta)
-                        if response_start_timestamp_twilio is None:
-                            response_start_timestamp_twilio = latest_media_timestamp
-                            if SHOW_TIMING_MATH:
-                                print(f"Setting start timestamp for new response: {response_start_timestamp_twilio}ms")
-                        if response_data.get('item_id'):
-                            last_assistant_item = response_data['item_id']
-                        await send_mark(websocket, stream_sid)
-                    if response_data.get('type') == 'response.content.done':
-                        print(f"Complete AI response: {current_ai_response}")
-                        current_ai_response = ""
-                    if response_data.get('type') == 'input_text.delta' and 'delta' in response_data:
-                        user_text = response_data['delta'].get('text', '')
-                        if user_text:
-                            current_user_input += user_text
-                            print(f"User input transcribed by OpenAI: {current_user_input}")
-                            if len(current_user_input) > 3 and stream_sid:
-                                await send_to_webhook(
-                                    call_sid=stream_sid,
-                                    message_type="user",
-                                    content=current_user_input,
-                                    speaker="Caller",
-                                    confidence=None,
-                                    is_partial=True
-                                )
-                    if response_data.get('type') == 'input_audio_buffer.speech_started':
-                        print("Speech started detected.")
-                        if last_assistant_item:
-                            print(f"Interrupting response with id: {last_assistant_item}")
-                            await handle_speech_started_event()
-                    if response_data.get('type') == 'input_audio_buffer.speech_stopped':
-                        if current_user_input:
-                            print(f"Complete user input: {current_user_input}")
-                            current_user_input = ""
-            except Exception as e:
-                print(f"Error in send_to_twilio: {e}")
-
-        async def handle_speech_started_event():
-            nonlocal response_start_timestamp_twilio, last_assistant_item
-            print("Handling speech started event.")
-            if mark_queue and response_start_timestamp_twilio is not None:
-                elapsed_time = latest_media_timestamp - response_start_timestamp_twilio
-                if SHOW_TIMING_MATH:
-                    print(f"Calculating elapsed time for truncation: {latest_media_timestamp} - {response_start_timestamp_twilio} = {elapsed_time}ms")
-                if last_assistant_item:
-                    if SHOW_TIMING_MATH:
-                        print(f"Truncating item with ID: {last_assistant_item}, Truncated at: {elapsed_time}ms")
-                    truncate_event = {
-                        "type": "conversation.item.truncate",
-                        "item_id": last_assistant_item,
-                        "content_index": 0,
-                        "audio_end_ms": elapsed_time
-                    }
-                    await openai_ws.send(json.dumps(truncate_event))
-                await websocket.send_json({
-                    "event": "clear",
-                    "streamSid": stream_sid
-                })
-                mark_queue.clear()
-                last_assistant_item = None
-                response_start_timestamp_twilio = None
-
-        async def send_mark(connection, stream_sid):
-            if stream_sid:
-                mark_event = {
-                    "event": "mark",
-                    "streamSid": stream_sid,
-                    "mark": {"name": "responsePart"}
-                }
-                await connection.send_json(mark_event)
-                mark_queue.append('responsePart')
+    if not await realtime_admission.acquire():
+        print("Realtime session limit reached, closing media stream")
+        await websocket.close()
+        return
+    try:
+        openai_ws = await realtime_pool.acquire("default")
+    except BaseException:
+        realtime_admission.release()
+        raise
+    session = MediaStreamSession(
+        websocket, openai_ws,
+        mark_interval=MARK_INTERVAL_FRAMES,
+        pace_lead_ms=PACE_LEAD_MS if PACE_AUDIO else None
+    )
+    voice_gate = VoiceGate(VAD_THRESHOLD_DBFS, VAD_HANGOVER_MS, VAD_PREROLL_MS) if INBOUND_VAD else None
+
+    async def receive_from_twilio():
+        try:
+            async for message in websocket.iter_text():
+                data = codec.loads(message)
+                if data['event'] == 'media' and openai_ws.open:
+                    session.latest_media_timestamp = int(data['media']['timestamp'])
+                    payload = data['media']['payload']
+                    if audio_taps.inbound:
+                        audio_taps.feed_inbound(session.stream_sid, payload)
+                    if voice_gate is None:
+                        await openai_ws.send(audio_append(payload))
+                    else:
+                        for frame in voice_gate.process(payload):
+                            await openai_ws.send(audio_append(frame))
+                elif data['event'] == 'start':
+                    start = data['start']
+                    call_sid = start.get('callSid') or start.get('customParameters', {}).get('callSid')
+                    session.start(start['streamSid'], call_sid or start['streamSid'])
+                    media_streams.bind(session.stream_sid, session.call_sid)
+                    print(f"Incoming stream has started {session.stream_sid} for call {session.call_sid}")
+                elif data['event'] == 'mark':
+                    session.mark_played()
+                elif data['event'] == 'stop':
+                    print("Stream ended.")
+                    return
+        except WebSocketDisconnect:
+            print("Client disconnected.")
+
+    async def send_to_twilio():
+        try:
+            async for openai_message in openai_ws:
+                await realtime_events.dispatch(session, codec.loads(openai_message))
+        except Exception as e:
+            print(f"Error in send_to_twilio: {e}")
+
+    try:
+        reason = await session.run(receive_from_twilio(), send_to_twilio(), time_limit=CALL_DURATION_LIMIT or None)
+        print(f"Media stream {session.stream_sid} ended: {reason}")
+    finally:
+        await session.close()
+        if session.stream_sid:
+            media_streams.unbind(session.stream_sid)
+            await call_states.evict(session.call_sid)
+        if voice_gate is not None:
+            stats = voice_gate.stats()
+            print(f"Voice gate sent {stats['frames_out']} of {stats['frames_in']} caller frames to OpenAI")
+        realtime_admission.release()
+
+# Handlers for OpenAI realtime events, run as handler(session, event) in registration order
+realtime_events = EventRegistry()
+
+@realtime_events.on('response.audio.delta')
+async def relay_audio_delta(session, event):
+    audio_payload = event.get('delta')
+    if audio_payload is None:
+        return
+    if audio_taps.outbound:
+        audio_taps.feed_outbound(session.stream_sid, audio_payload)
+    if session.response_start_timestamp_twilio is None:
+        session.response_start_timestamp_twilio = session.latest_media_timestamp
+        if SHOW_TIMING_MATH:
+            print(f"Setting start timestamp for new response: {session.response_start_timestamp_twilio}ms")
+    if event.get('item_id'):
+        session.last_assistant_item = event['item_id']
+    if session.pacer is not None:
+        session.pacer.push(audio_payload, session.last_assistant_item)
+    else:
+        await session.send_audio(audio_payload)
 
-        await asyncio.gather(receive_from_twilio(), send_to_twilio())
+@realtime_events.on('response.audio.done')
+async def mark_response_end(session, event):
+    if session.pacer is not None:
+        session.pacer.boundary()
+    else:
+        await session.end_response()
+
+@realtime_events.on(*LOG_EVENT_TYPES)
+async def log_event(session, event):
+    print(f"Received event: {event['type']}", event)
+
+@realtime_events.on('conversation.item.input_audio_transcription.completed')
+async def record_user_transcript(session, event):
+    call_sid = session.call_sid
+    if 'transcript' in event and call_sid:
+        user_input = event['transcript']
+        await record_turn(await call_states.get(call_sid), "user", user_input)
+        print(f"User transcript: {user_input}")
+        await send_to_webhook(
+            call_sid=call_sid,
+            message_type="user",
+            content=user_input,
+            speaker="Caller"
+        )
+
+@realtime_events.on('response.audio_transcript.delta')
+async def update_assistant_partial(session, event):
+    if not event.get('delta'):
+        return
+    session.current_ai_response += event['delta']
+    print(f"AI response text: {session.current_ai_response}")
+    if len(session.current_ai_response) > 5 and session.call_sid:
+        partial_debouncer.update(session.call_sid, "assistant", session.current_ai_response)
+
+@realtime_events.on('response.audio_transcript.done')
+async def finish_assistant_partial(session, event):
+    print(f"Complete AI response: {session.current_ai_response}")
+    if session.call_sid:
+        await partial_debouncer.flush(session.call_sid, "assistant")
+    session.current_ai_response = ""
+
+@realtime_events.on('response.audio_transcript.done')
+async def record_assistant_transcript(session, event):
+    call_sid = session.call_sid
+    if 'transcript' in event and call_sid:
+        ai_response = event['transcript']
+        await record_turn(await call_states.get(call_sid), "assistant", ai_response)
+        print(f"AI transcript: {ai_response}")
+        await send_to_webhook(
+            call_sid=call_sid,
+            message_type="assistant",
+            content=ai_response,
+            speaker="You"
+        )
+
+@realtime_events.on(*TRANSCRIPT_DELTA_EVENTS)
+async def update_user_partial(session, event):
+    user_text = transcript_delta(event)
+    if user_text:
+        session.current_user_input += user_text
+        print(f"User input transcribed by OpenAI: {session.current_user_input}")
+        if len(session.current_user_input) > 3 and session.call_sid:
+            partial_debouncer.update(session.call_sid, "user", session.current_user_input)
+
+@realtime_events.on('input_audio_buffer.speech_started')
+async def handle_speech_started_event(session, event):
+    print("Speech started detected.")
+    if not session.last_assistant_item:
+        return
+    print(f"Interrupting response with id: {session.last_assistant_item}")
+    print("Handling speech started event.")
+    if session.pacer is not None:
+        if not (session.pacer.active or session.playing):
+            return
+        played_item = session.pacer.item_id
+        played_ms = session.pacer.clear()
+        elapsed_time = played_ms if played_item == session.last_assistant_item else 0
+    elif session.playing and session.response_start_timestamp_twilio is not None:
+        elapsed_time = session.latest_media_timestamp - session.response_start_timestamp_twilio
+        if SHOW_TIMING_MATH:
+            print(f"Calculating elapsed time for truncation: {session.latest_media_timestamp} - {session.response_start_timestamp_twilio} = {elapsed_time}ms")
+    else:
+        return
+    if SHOW_TIMING_MATH:
+        print(f"Truncating item with ID: {session.last_assistant_item}, Truncated at: {elapsed_time}ms")
+    truncate_event = {
+        "type": "conversation.item.truncate",
+        "item_id": session.last_assistant_item,
+        "content_index": 0,
+        "audio_end_ms": elapsed_time
+    }
+    await session.openai_ws.send(codec.dumps(truncate_event))
+    await session.websocket.send_text(session.frames.clear)
+    session.clear_marks()
+    session.last_assistant_item = None
+    session.response_start_timestamp_twilio = None
+
+@realtime_events.on('input_audio_buffer.speech_stopped')
+async def finish_user_partial(session, event):
+    if session.current_user_input:
+        print(f"Complete user input: {session.current_user_input}")
+        session.current_user_input = ""
+    if session.call_sid:
+        await partial_debouncer.flush(session.call_sid, "user")
 
 async def send_initial_conversation_item(openai_ws):
     initial_conversation_item = {
@@ -527,7 +766,7 @@ async def initialize_session(openai_ws):
             "modalities": ["text", "audio"],
             "temperature": 0.8,
             "input_audio_transcription": {
-                "model": "whisper-1"
+                "model": TRANSCRIPTION_MODEL
             }
         }
     }
@@ -536,6 +775,13 @@ async def initialize_session(openai_ws):
     # Uncomment the next line to have the AI speak first
     # await send_initial_conversation_item(openai_ws)
 
+realtime_pool.add_profile("default", initialize_session)
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    if WORKERS > 1:
+        if CALL_STATE_BACKEND == 'memory':
+            print("Warning: the memory call state backend is per worker; set CALL_STATE_BACKEND to share calls between workers.")
+        uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
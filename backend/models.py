@@ -40,6 +40,8 @@ class User(BaseModel):
     background_info: Optional[str] = None
     previous_call_history: List[CallHistory] = []
     profile: Optional[PersonBackgroundInfo] = None
+    # Words that mean the user is in danger when said on a call
+    code_words: List[str] = []
     
 class UserBase(BaseModel):
     pass
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import random
+import re
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_SCALE = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+_SENTENCE_END = re.compile(r"[.!?][\"')\]]*\s")
+
+
+def parse_reset(value):
+    """Parse OpenAI reset durations such as '20ms', '1s' or '6m0s' into seconds."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_SCALE[unit] for amount, unit in parts)
+
+
+class OpenAIClient:
+    """
+    Application-wide HTTP client for the OpenAI REST API.
+
+    One pooled, keep-alive (and HTTP/2 when h2 is installed) connection set
+    is shared by every call. Requests that fail with 429/5xx or a connection
+    error are retried up to max_retries times. The wait before each retry
+    follows Retry-After or the x-ratelimit-reset-* headers when the server
+    sends them, and jittered exponential backoff otherwise. The latest
+    x-ratelimit-* values are kept in rate_limits.
+    """
+
+    def __init__(self, api_key, base_url="https://api.openai.com/v1", timeout=30.0,
+                 max_connections=50, keepalive_expiry=60.0, http2=True,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limits = {}
+        self.counters = {"requests": 0, "retries": 0, "errors": 0}
+        self._client = None
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=self.http2,
+            timeout=httpx.Timeout(self.timeout, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
+        )
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def post(self, path, payload):
+        """POST JSON to the API with retries and return the final httpx.Response."""
+        return await self._send(path, payload, stream=False)
+
+    async def stream(self, path, payload):
+        """
+        POST JSON with stream=True and yield each decoded server-sent event.
+
+        Retries only happen before the first event; a non-200 final response
+        raises httpx.HTTPStatusError.
+        """
+        response = await self._send(path, dict(payload, stream=True), stream=True)
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
+        finally:
+            await response.aclose()
+
+    async def _send(self, path, payload, stream):
+        if self._client is None:
+            await self.start()
+        attempt = 0
+        while True:
+            self.counters["requests"] += 1
+            try:
+                request = self._client.build_request("POST", path, json=payload)
+                response = await self._client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.RemoteProtocolError) as e:
+                if attempt >= self.max_retries:
+                    self.counters["errors"] += 1
+                    raise
+                delay = self._backoff(attempt)
+                print(f"OpenAI request failed ({e}), retrying in {delay:.2f}s")
+            else:
+                self._update_rate_limits(response)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    if response.status_code >= 400:
+                        self.counters["errors"] += 1
+                    return response
+                if stream:
+                    await response.aclose()
+                delay = self._retry_delay(response, attempt)
+                print(f"OpenAI returned {response.status_code}, retrying in {delay:.2f}s")
+            attempt += 1
+            self.counters["retries"] += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return dict(self.counters, http2=self.http2, rate_limits=self.rate_limits)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _retry_delay(self, response, attempt):
+        hint = parse_reset(response.headers.get("retry-after"))
+        if hint is None and response.status_code == 429:
+            resets = [parse_reset(response.headers.get(header))
+                      for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+            resets = [reset for reset in resets if reset is not None]
+            hint = max(resets) if resets else None
+        if hint is None:
+            return self._backoff(attempt)
+        # Small jitter so calls that were limited together don't retry in lockstep
+        return min(self.backoff_max, hint) + random.uniform(0, self.backoff_base / 2)
+
+    def _update_rate_limits(self, response):
+        for header, value in response.headers.items():
+            if header.startswith("x-ratelimit-"):
+                self.rate_limits[header[len("x-ratelimit-"):]] = value
+
+
+def first_sentence_end(text, start=0, min_chars=20):
+    """Index just past the first sentence of at least min_chars in text, or None."""
+    match = _SENTENCE_END.search(text, max(start, min_chars - 1))
+    return match.end() if match else None
+
+
+async def split_first_sentence(deltas, on_complete=None, min_chars=20):
+    """
+    Consume a stream of text deltas until the first full sentence is available.
+
+    Returns (first_sentence, task). The task keeps consuming the stream in the
+    background, awaits on_complete(full_text) if given, and resolves to the
+    full text. If the stream ends before a sentence boundary, first_sentence
+    is the whole text and the task is already finished.
+    """
+    first = asyncio.get_running_loop().create_future()
+
+    async def consume():
+        text = ""
+        async for delta in deltas:
+            scanned = len(text)
+            text += delta
+            if not first.done():
+                end = first_sentence_end(text, max(0, scanned - 2), min_chars)
+                if end is not None:
+                    first.set_result(text[:end].strip())
+        if on_complete is not None:
+            await on_complete(text)
+        if not first.done():
+            first.set_result(text.strip())
+        return text
+
+    task = asyncio.create_task(consume())
+    await asyncio.wait((first, task), return_when=asyncio.FIRST_COMPLETED)
+    if task.done():
+        task.result()
+    return first.result(), task
@@ -0,0 +1,116 @@
+import asyncio
+import collections
+
+# g711 μ-law at 8 kHz is one byte per sample
+MULAW_BYTES_PER_MS = 8
+
+
+def mulaw_duration_ms(payload):
+    """Playback length of a base64 8 kHz μ-law payload, without decoding it."""
+    size = len(payload) // 4 * 3 - payload[-2:].count("=")
+    return size / MULAW_BYTES_PER_MS
+
+
+class AudioPacer:
+    """
+    Meters AI audio out to Twilio at playback rate.
+
+    The realtime API delivers audio faster than real time. Instead of
+    handing Twilio the whole burst, frames wait here and are sent once
+    Twilio has less than lead_ms of audio buffered, so an interruption only
+    has to clear that much. Because every frame's length is known, the pacer
+    also knows how much of the current item the caller has actually heard:
+    played_ms() is the position to truncate the item at.
+
+    Frames are pushed with push(payload, item_id); boundary() queues a call
+    to on_boundary() after everything pushed before it has been sent. A
+    failed send stops the pacer, and join() raises the error so whoever
+    supervises the stream can end it.
+    """
+
+    def __init__(self, send, on_boundary=None, lead_ms=200.0):
+        self.send = send
+        self.on_boundary = on_boundary
+        self.lead_ms = lead_ms
+        self.item_id = None
+        self._queue = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._sent_ms = 0.0
+        # Loop time at which the current item started (or would have started) playing
+        self._base = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            # A send error has already been raised through join()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._queue.clear()
+
+    async def join(self):
+        """Wait for the pacer to stop, raising the send error that stopped it."""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    def push(self, payload, item_id=None):
+        self._queue.append((payload, item_id, mulaw_duration_ms(payload)))
+        self._wakeup.set()
+
+    def boundary(self):
+        self._queue.append((None, None, 0.0))
+        self._wakeup.set()
+
+    @property
+    def active(self):
+        """Whether any of the current item's audio is still queued or playing."""
+        return bool(self._queue) or self.played_ms() < self._sent_ms
+
+    def played_ms(self):
+        """How much of the current item's audio has played out, in milliseconds."""
+        if self._base is None:
+            return 0.0
+        elapsed = (asyncio.get_running_loop().time() - self._base) * 1000
+        return max(0.0, min(self._sent_ms, elapsed))
+
+    def clear(self):
+        """Drop unsent audio and return how much of the current item was played."""
+        played = self.played_ms()
+        self._queue.clear()
+        self._sent_ms = played
+        return int(played)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            payload, item_id, duration = self._queue[0]
+            if payload is None:
+                self._queue.popleft()
+                if self.on_boundary is not None:
+                    await self.on_boundary()
+                continue
+            now = loop.time()
+            if item_id != self.item_id:
+                # A new item starts playing once whatever is left of the previous one has
+                leftover = self._sent_ms - self.played_ms()
+                self.item_id = item_id
+                self._sent_ms = 0.0
+                self._base = now + leftover / 1000
+            ahead = self._sent_ms - self.played_ms()
+            if ahead > self.lead_ms:
+                await asyncio.sleep((ahead - self.lead_ms) / 1000)
+                continue
+            if self._base is None or (now - self._base) * 1000 > self._sent_ms:
+                # Twilio ran dry, so playback resumes with this frame
+                self._base = now - self._sent_ms / 1000
+            self._queue.popleft()
+            self._sent_ms += duration
+            await self.send(payload)
@@ -0,0 +1,204 @@
+import asyncio
+import collections
+
+from starlette.websockets import WebSocketState
+
+from frames import TwilioFrames
+from pacing import AudioPacer
+
+
+# Realtime events carrying partial transcripts of the caller's speech. Only the
+# gpt-4o transcription models send them; whisper-1 only sends the completed transcript.
+TRANSCRIPT_DELTA_EVENTS = ('conversation.item.input_audio_transcription.delta',)
+
+
+def transcript_delta(event):
+    """Text of a partial transcript event."""
+    return event.get("delta") or ""
+
+
+class EventRegistry:
+    """
+    Maps OpenAI realtime event types to handler coroutines.
+
+    Handlers are registered with on(*event_types), also usable as a
+    decorator, and run as handler(session, event) in registration order.
+    Looking up an event type is a single dict access, so events nothing
+    listens to cost next to nothing.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+
+    def on(self, *event_types):
+        def register(handler):
+            for event_type in event_types:
+                self._handlers[event_type] = self._handlers.get(event_type, ()) + (handler,)
+            return handler
+        return register
+
+    def handlers(self, event_type):
+        return self._handlers.get(event_type, ())
+
+    async def dispatch(self, session, event):
+        handlers = self._handlers.get(event["type"])
+        if handlers:
+            for handler in handlers:
+                await handler(session, event)
+
+
+class StreamRegistry:
+    """
+    The call each live media stream belongs to.
+
+    Twilio media stream messages only carry the streamSid, while call state,
+    transcripts and webhooks are keyed by CallSid; the start message is the
+    one place both appear, so the stream is bound to its call there and the
+    session keeps the CallSid for everything it records. The registry
+    itself only tracks which streams are live, for /metrics.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def bind(self, stream_sid, call_sid):
+        self._calls[stream_sid] = call_sid
+
+    def unbind(self, stream_sid):
+        """Forget a finished stream and return the call it belonged to."""
+        return self._calls.pop(stream_sid, None)
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class MediaStreamSession:
+    """
+    State of one Twilio media stream bridged to an OpenAI realtime socket.
+
+    call_sid is the call the stream belongs to, from Twilio's start message;
+    everything recorded about the call is keyed by it, not by stream_sid.
+    detector, if set, is the DangerDetector for the caller's code words,
+    and matcher watches the caller's partial transcripts with it.
+    speech_started_at is when the caller's current utterance began.
+
+    Twilio echoes a mark back once all audio sent before it has played, so
+    marks are how the session knows whether the caller is still hearing the
+    AI. Rather than one mark per audio frame, a mark goes out every
+    mark_interval frames (0 for none) and at the end of each response;
+    frames sent since the last mark count as still playing.
+
+    With pace_lead_ms set, AI audio goes through an AudioPacer that keeps
+    only that much audio buffered at Twilio.
+
+    run() supervises the coroutines relaying each direction, and the pacer:
+    when one of them finishes or fails, or the time limit passes, the rest
+    are cancelled.
+    close() then closes both sockets, once.
+    """
+
+    __slots__ = (
+        "websocket", "openai_ws", "stream_sid", "call_sid", "detector", "matcher", "frames",
+        "latest_media_timestamp", "last_assistant_item", "mark_queue", "mark_interval", "unmarked_frames",
+        "pacer", "response_start_timestamp_twilio", "current_ai_response", "current_user_input",
+        "speech_started_at", "closed"
+    )
+
+    def __init__(self, websocket, openai_ws, mark_interval=1, pace_lead_ms=None):
+        self.websocket = websocket
+        self.openai_ws = openai_ws
+        self.stream_sid = None
+        self.call_sid = None
+        self.detector = None
+        self.matcher = None
+        # Outbound Twilio frames are templated once the streamSid is known
+        self.frames = TwilioFrames(None)
+        self.latest_media_timestamp = 0
+        self.last_assistant_item = None
+        self.mark_queue = collections.deque()
+        self.mark_interval = mark_interval
+        self.unmarked_frames = 0
+        self.pacer = None
+        if pace_lead_ms is not None:
+            self.pacer = AudioPacer(self.send_audio, on_boundary=self.end_response, lead_ms=pace_lead_ms)
+            self.pacer.start()
+        self.response_start_timestamp_twilio = None
+        self.current_ai_response = ""
+        self.current_user_input = ""
+        self.speech_started_at = None
+        self.closed = False
+
+    def start(self, stream_sid, call_sid=None):
+        self.stream_sid = stream_sid
+        self.call_sid = call_sid
+        self.frames = TwilioFrames(stream_sid)
+        self.latest_media_timestamp = 0
+
+    @property
+    def playing(self):
+        """Whether audio sent to Twilio may still be playing to the caller."""
+        return bool(self.mark_queue) or self.unmarked_frames > 0
+
+    async def send_audio(self, payload):
+        """Send a base64 μ-law frame to Twilio, marking every mark_interval frames."""
+        await self.websocket.send_text(self.frames.media(payload))
+        self.unmarked_frames += 1
+        if self.mark_interval and self.unmarked_frames >= self.mark_interval:
+            await self.send_mark()
+
+    async def end_response(self):
+        """Mark the end of a response so the tail of its audio is tracked too."""
+        if self.unmarked_frames:
+            await self.send_mark()
+
+    async def send_mark(self, name="responsePart"):
+        if self.stream_sid:
+            await self.websocket.send_text(self.frames.mark(name))
+            self.mark_queue.append(name)
+            self.unmarked_frames = 0
+
+    def mark_played(self):
+        if self.mark_queue:
+            self.mark_queue.popleft()
+
+    def clear_marks(self):
+        self.mark_queue.clear()
+        self.unmarked_frames = 0
+
+    async def run(self, *coroutines, time_limit=None):
+        """
+        Run coroutines until the first one returns or raises, or time_limit
+        seconds pass, then cancel and wait for the rest. Returns why it stopped.
+        """
+        tasks = [asyncio.create_task(coroutine, name=coroutine.__name__) for coroutine in coroutines]
+        if self.pacer is not None:
+            tasks.append(asyncio.create_task(self.pacer.join(), name="audio_pacer"))
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=time_limit, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if not done:
+            return "time limit reached"
+        task = done.pop()
+        if not task.cancelled() and task.exception() is not None:
+            return f"{task.get_name()} failed: {task.exception()!r}"
+        return f"{task.get_name()} finished"
+
+    async def close(self):
+        """Stop pacing and close both sockets; safe to call more than once."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.pacer is not None:
+            await self.pacer.stop()
+        try:
+            await self.openai_ws.close()
+        except Exception as e:
+            print(f"Error closing realtime socket: {e}")
+        if self.websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close()
+            except Exception as e:
+                print(f"Error closing Twilio socket: {e}")
@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import time
+
+
+class _Profile:
+    __slots__ = ("initialize", "ready", "filling")
+
+    def __init__(self, initialize):
+        self.initialize = initialize
+        # (connection, connected_at) pairs, oldest first
+        self.ready = collections.deque()
+        self.filling = None
+
+
+class RealtimePool:
+    """
+    Pre-connected, pre-initialized OpenAI realtime sockets.
+
+    Sockets are kept per session profile: a name plus the coroutine that
+    sends its session.update (voice, instructions, ...). acquire() hands out
+    a ready socket, or connects a new one if none is ready, and the profile
+    is topped back up to size in the background. Sockets that have sat
+    ready for longer than max_idle seconds, or that the server closed, are
+    discarded. A socket is never returned to the pool; the caller closes it.
+
+    Every ready socket is an open OpenAI session, reconnected each max_idle
+    seconds even with no calls, so pre-warming is opt-in: with size 0
+    (the default) acquire() just connects on demand.
+    """
+
+    def __init__(self, connect, size=0, max_idle=300.0, check_interval=10.0):
+        self.connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "errors": 0}
+        self._profiles = {}
+        self._task = None
+
+    def add_profile(self, name, initialize):
+        """Register initialize(connection) as the session setup for profile name."""
+        self._profiles[name] = _Profile(initialize)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for profile in self._profiles.values():
+            if profile.filling is not None:
+                profile.filling.cancel()
+            while profile.ready:
+                await self._close(profile.ready.popleft()[0])
+
+    async def acquire(self, name):
+        """Return an initialized realtime connection for the profile."""
+        profile = self._profiles[name]
+        try:
+            while profile.ready:
+                connection, connected_at = profile.ready.popleft()
+                if connection.open and time.monotonic() - connected_at < self.max_idle:
+                    self.counters["hits"] += 1
+                    return connection
+                self.counters["expired"] += 1
+                await self._close(connection)
+            self.counters["misses"] += 1
+            return await self._open(profile)
+        finally:
+            self._replenish(profile)
+
+    def stats(self):
+        return dict(self.counters, ready={name: len(profile.ready) for name, profile in self._profiles.items()})
+
+    async def _open(self, profile):
+        connection = await self.connect()
+        try:
+            await profile.initialize(connection)
+        except BaseException:
+            await self._close(connection)
+            raise
+        return connection
+
+    async def _close(self, connection):
+        try:
+            await connection.close()
+        except Exception:
+            pass
+
+    def _replenish(self, profile):
+        if self.size > 0 and (profile.filling is None or profile.filling.done()):
+            profile.filling = asyncio.create_task(self._fill(profile))
+
+    async def _fill(self, profile):
+        while len(profile.ready) < self.size:
+            try:
+                connection = await self._open(profile)
+            except Exception as e:
+                # Left for the next check to retry
+                self.counters["errors"] += 1
+                print(f"Error pre-connecting realtime session: {e}")
+                return
+            profile.ready.append((connection, time.monotonic()))
+
+    async def _run(self):
+        while True:
+            cutoff = time.monotonic() - self.max_idle
+            for profile in self._profiles.values():
+                stale = [entry for entry in profile.ready if entry[1] <= cutoff or not entry[0].open]
+                for entry in stale:
+                    profile.ready.remove(entry)
+                self.counters["expired"] += len(stale)
+                for connection, _ in stale:
+                    await self._close(connection)
+                self._replenish(profile)
+            await asyncio.sleep(self.check_interval)
@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import json
+import sqlite3
+import time
+
+from aiohttp import web
+
+from alerts import AlertOutbox
+
+
+@contextlib.asynccontextmanager
+async def receiver(statuses=()):
+    """A local webhook that answers with statuses in turn, then 200, and records what it got."""
+    received = []
+    statuses = list(statuses)
+
+    async def handle(request):
+        received.append((request.headers.get("Idempotency-Key"), await request.json()))
+        return web.Response(status=statuses.pop(0) if statuses else 200)
+
+    app = web.Application()
+    app.router.add_post("/api/webhook", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    try:
+        yield f"http://{host}:{port}/api/webhook", received
+    finally:
+        await runner.cleanup()
+
+
+async def settled(*outboxes, timeout=3.0):
+    """Wait until no alert is left pending in the outboxes."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = [await outbox.stats() for outbox in outboxes]
+        if not any(stat["pending"] for stat in stats):
+            return stats
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"alerts still pending: {stats}")
+
+
+def test_alert_is_retried_then_marked_failed_when_rejected(tmp_path):
+    async def scenario():
+        async with receiver([503, 400]) as (url, received):
+            outbox = AlertOutbox([url], path=str(tmp_path / "alerts.db"), retry_base=0.01)
+            await outbox.start()
+            try:
+                keys = await outbox.submit("CA1", {"id": 1, "type": "emergency"})
+                stats = (await settled(outbox))[0]
+            finally:
+                await outbox.stop()
+        return keys, received, stats
+
+    keys, received, stats = asyncio.run(scenario())
+    # The retry carries the same key, so the receiver can tell it apart from a new alert
+    assert [key for key, _ in received] == keys * 2
+    assert received[0][1] == {"transcriptions": [], "insights": [{"id": 1, "type": "emergency"}]}
+    assert stats["retries"] == 1
+    assert stats["failed"] == 1
+    assert stats["failed_stored"] == 1
+
+
+def test_alert_gives_up_after_max_attempts(tmp_path):
+    async def scenario():
+        async with receiver([503] * 10) as (url, received):
+            outbox = AlertOutbox([url], path=str(tmp_path / "alerts.db"), retry_base=0.01, max_attempts=3)
+            await outbox.start()
+            try:
+                await outbox.submit("CA1", {"id": 1})
+                stats = (await settled(outbox))[0]
+            finally:
+                await outbox.stop()
+        return received, stats
+
+    received, stats = asyncio.run(scenario())
+    assert len(received) == 3
+    assert stats["failed_stored"] == 1
+
+
+def test_alerts_left_by_a_previous_run_are_sent_once_by_two_workers(tmp_path):
+    path = str(tmp_path / "alerts.db")
+
+    async def scenario():
+        async with receiver([503] * 5) as (url, received):
+            # The first run only gets errors, and would not retry for a long while
+            first = AlertOutbox([url], path=path, retry_base=60.0)
+            await first.start()
+            keys = []
+            for i in range(5):
+                keys += await first.submit(f"CA{i}", {"id": i})
+            await asyncio.sleep(0.3)
+            await first.stop()
+            failed_attempts = len(received)
+
+            workers = [AlertOutbox([url], path=path) for _ in range(2)]
+            for worker in workers:
+                await worker.start()
+            try:
+                await settled(*workers)
+            finally:
+                for worker in workers:
+                    await worker.stop()
+        return keys, failed_attempts, received[failed_attempts:]
+
+    keys, failed_attempts, delivered = asyncio.run(scenario())
+    assert failed_attempts == 5
+    # Each alert is claimed by exactly one of the workers sharing the outbox
+    assert sorted(key for key, _ in delivered) == sorted(keys)
+
+
+def test_outbox_from_before_leases_and_urls_is_migrated_and_sent(tmp_path):
+    path = str(tmp_path / "alerts.db")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE alert_outbox ("
+        "key TEXT PRIMARY KEY, call_sid TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL, "
+        "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, failed INTEGER NOT NULL DEFAULT 0)"
+    )
+    db.execute(
+        "INSERT INTO alert_outbox (key, call_sid, payload, created, next_attempt) VALUES (?, ?, ?, ?, ?)",
+        ("old-key", "CA1", json.dumps({"id": 1}), time.time(), time.time() + 3600)
+    )
+    db.commit()
+    db.close()
+
+    async def scenario():
+        async with receiver() as (url, received):
+            outbox = AlertOutbox([url, url.replace("127.0.0.1", "localhost")], path=path)
+            await outbox.start()
+            try:
+                stats = (await settled(outbox))[0]
+            finally:
+                await outbox.stop()
+        return received, stats
+
+    received, stats = asyncio.run(scenario())
+    # A row from before per-URL delivery goes to the first URL only
+    assert [key for key, _ in received] == ["old-key"]
+    assert stats["delivered"] == 1
+    columns = {row[1] for row in sqlite3.connect(path).execute("PRAGMA table_info(alert_outbox)")}
+    assert {"owner", "lease_until", "url"} <= columns
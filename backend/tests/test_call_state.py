@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from call_state import CallStateStore, Turn, create_backend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend_url(request, tmp_path):
+    return "memory" if request.param == "memory" else f"sqlite:///{tmp_path / 'calls.db'}"
+
+
+def test_idle_calls_are_evicted_after_ttl(backend_url):
+    async def scenario():
+        store = CallStateStore(create_backend(backend_url), ttl=0.1)
+        evicted = []
+        store.on_evict(lambda call_sid, state: evicted.append((call_sid, state)))
+        idle = await store.get("CA1")
+        idle.add_turn(Turn("user", "hello", "2025-01-01T00:00:00"))
+        await store.save(idle)
+        await store.get("CA2")
+        await asyncio.sleep(0.15)
+        await store.save(await store.get("CA2"))
+        await store.sweep()
+        stats = await store.stats()
+        await store.stop()
+        return evicted, stats
+
+    evicted, stats = asyncio.run(scenario())
+    assert [call_sid for call_sid, _ in evicted[:1]] == ["CA1"]
+    # The hook still gets the call's turns, so its transcript can be flushed
+    assert [turn.content for turn in evicted[0][1].turns] == ["hello"]
+    assert stats == {"calls": 1, "evictions": 1}
+
+
+def test_least_recently_used_call_is_evicted_past_max_calls(backend_url):
+    async def scenario():
+        store = CallStateStore(create_backend(backend_url), max_calls=2)
+        evicted = []
+        store.on_evict(lambda call_sid, state: evicted.append(call_sid))
+        for call_sid in ("CA1", "CA2"):
+            await store.save(await store.get(call_sid))
+            await asyncio.sleep(0.01)
+        await store.save(await store.get("CA1"))
+        await asyncio.sleep(0.01)
+        await store.get("CA3")
+        stats = await store.stats()
+        await store.stop()
+        return evicted, stats
+
+    evicted, stats = asyncio.run(scenario())
+    assert evicted[:1] == ["CA2"]
+    assert stats["calls"] == 2
+
+
+def test_sqlite_backend_shares_calls_between_workers(tmp_path):
+    url = f"sqlite:///{tmp_path / 'calls.db'}"
+
+    async def scenario():
+        first = CallStateStore(create_backend(url))
+        second = CallStateStore(create_backend(url))
+        released = []
+        second.on_evict(lambda call_sid, state: released.append((call_sid, state)))
+
+        state = await first.get("CA1")
+        state.code_words = ("tiger",)
+        state.add_turn(Turn("user", "hello", "2025-01-01T00:00:00", confidence=0.9))
+        await first.save(state)
+        seen = await second.get("CA1")
+
+        # Only the worker that evicts the call gets its state; the other lets go on its next sweep
+        await first.evict("CA1")
+        await second.sweep()
+        await first.stop()
+        await second.stop()
+        return seen, released
+
+    seen, released = asyncio.run(scenario())
+    assert seen.code_words == ("tiger",)
+    assert seen.turn_count == 1
+    assert [turn.to_dict() for turn in seen.turns] == [
+        {"role": "user", "content": "hello", "timestamp": "2025-01-01T00:00:00", "confidence": 0.9}
+    ]
+    assert released == [("CA1", None)]
@@ -0,0 +1,62 @@
+import pytest
+
+from danger import DangerDetector, StreamingMatcher, detector_for
+
+
+@pytest.mark.parametrize("text", [
+    "there's a pineapple on the counter",
+    "Pineapple!",
+    "I could go for some pine apple",
+    "I'd like a pine-apple",
+    "a pinapple smoothie",
+    "pineappel",
+])
+def test_code_word_matches(text):
+    assert detector_for().code_word(text) == "pineapple"
+
+
+@pytest.mark.parametrize("text", [
+    "that was a fine apple",
+    "spineapple",
+    "the pine tree and an apple",
+])
+def test_ordinary_speech_near_pineapple_does_not_match(text):
+    assert detector_for().code_word(text) is None
+
+
+def test_short_code_word_only_matches_exactly():
+    detector = detector_for(["tiger"])
+    assert detector.code_word("I saw a tiger") == "tiger"
+    assert detector.code_word("set a timer") is None
+    assert detector.code_word("a tigers tale") is None
+
+
+def test_concern_words_match_whole_words_only():
+    detector = DangerDetector()
+    assert detector.scan("please help me").concerns == ("help",)
+    assert detector.scan("that was helpful").concerns == ()
+
+
+def test_streaming_matcher_finds_code_word_across_deltas():
+    matcher = StreamingMatcher(detector_for())
+    assert matcher.feed("I want a pine", "item_1") is None
+    assert matcher.feed("apple now", "item_1") == "pineapple"
+    assert matcher.feed(" pineapple", "item_1") is None
+
+
+def test_streaming_matcher_does_not_join_utterances():
+    matcher = StreamingMatcher(detector_for())
+    assert matcher.feed("I cut down a pine", "item_1") is None
+    assert matcher.feed("Apple juice please", "item_2") is None
+    matcher.reset()
+    assert matcher.feed("pine", "item_3") is None
+    matcher.reset()
+    assert matcher.feed("apple juice please", "item_3") is None
+
+
+def test_streaming_matcher_waits_for_the_end_of_the_last_word():
+    matcher = StreamingMatcher(detector_for(["tiger"]))
+    assert matcher.feed("I saw a tiger", "item_1") is None
+    assert matcher.feed("s at the zoo", "item_1") is None
+    assert matcher.feed("I saw a tiger", "item_2") is None
+    assert matcher.feed(" just now", "item_2") == "tiger"
@@ -0,0 +1,57 @@
+import json
+import os
+
+from transcripts import TranscriptWriter
+
+
+def records(*timestamps, role="user"):
+    return [{"role": role, "content": f"turn at {timestamp}", "timestamp": timestamp} for timestamp in timestamps]
+
+
+def test_export_compacts_lines_into_json_array(tmp_path):
+    writer = TranscriptWriter(str(tmp_path))
+    writer.start()
+    for record in records("00:01", "00:02"):
+        writer.append("CA1", record)
+    writer.export("CA1")
+    # A call that keeps going after an export extends the same array
+    writer.append("CA1", records("00:03")[0])
+    writer.export("CA1")
+    writer.stop()
+
+    jsonl_path, json_path = writer.paths("CA1")
+    with open(json_path) as f:
+        assert json.load(f) == records("00:01", "00:02", "00:03")
+    assert not os.path.exists(jsonl_path)
+
+
+def test_stop_exports_calls_still_open(tmp_path):
+    writer = TranscriptWriter(str(tmp_path))
+    writer.start()
+    writer.append("CA1", records("00:01")[0])
+    writer.stop()
+
+    with open(writer.paths("CA1")[1]) as f:
+        assert json.load(f) == records("00:01")
+    assert os.listdir(tmp_path) == [os.path.basename(writer.paths("CA1")[1])]
+
+
+def test_parts_from_several_workers_merge_in_timestamp_order(tmp_path):
+    caller = TranscriptWriter(str(tmp_path), part=1)
+    assistant = TranscriptWriter(str(tmp_path), part=2)
+    caller.start()
+    assistant.start()
+    for record in records("00:01", "00:03"):
+        caller.append("CA1", record)
+    for record in records("00:02", "00:04", role="assistant"):
+        assistant.append("CA1", record)
+    caller.export("CA1")
+    assistant.export("CA1")
+    caller.stop()
+    assistant.stop()
+
+    with open(caller.paths("CA1")[1]) as f:
+        merged = json.load(f)
+    assert [record["timestamp"] for record in merged] == ["00:01", "00:02", "00:03", "00:04"]
+    assert not os.path.exists(caller.paths("CA1")[0])
+    assert not os.path.exists(assistant.paths("CA1")[0])
@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+from webhooks import CallbackSink, WebhookDispatcher
+
+
+def test_submit_after_idle_gap_is_sent_within_flush_interval():
+    async def scenario():
+        received = []
+        dispatcher = WebhookDispatcher(flush_interval=0.05, idle_timeout=5.0)
+        dispatcher.add_sink(CallbackSink(lambda data: received.append((time.monotonic(), data))))
+        await dispatcher.start()
+        try:
+            dispatcher.submit("CA1", transcriptions=[{"text": "first"}])
+            await asyncio.sleep(0.3)
+            submitted = time.monotonic()
+            dispatcher.submit("CA1", transcriptions=[{"text": "second"}])
+            await asyncio.sleep(0.3)
+        finally:
+            await dispatcher.stop()
+        return submitted, received
+
+    submitted, received = asyncio.run(scenario())
+    assert [data["transcriptions"][0]["text"] for _, data in received] == ["first", "second"]
+    assert received[1][0] - submitted < 0.25
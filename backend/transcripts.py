@@ -0,0 +1,164 @@
+import contextlib
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class TranscriptWriter:
+    """
+    Append-only transcript persistence on a dedicated writer thread.
+
+    Every turn is written as one JSON line to transcripts/call_<sid>_<date>.jsonl
+    through a per-call file handle that stays open for the life of the call.
+    Handles are flushed after each batch of writes and fsynced at most every
+    fsync_interval seconds. export() closes the call's handle and compacts the
+    lines into the original call_<sid>_<date>.json array format, extending
+    the array if the call was already exported once.
+
+    All methods other than start/stop only put work on a queue, so request
+    handlers never touch the disk themselves.
+
+    When several workers write the same call, give each its own part (e.g.
+    its pid): lines then go to call_<sid>_<date>.<part>.jsonl, and export()
+    only compacts this worker's own part, merging it into the .json array in
+    timestamp order under a file lock. No worker ever removes a file
+    another one still has open.
+    """
+
+    def __init__(self, directory="transcripts", fsync_interval=1.0, part=None):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.part = part
+        self._queue = queue.Queue()
+        self._thread = None
+        self._files = {}
+        self._dirty = set()
+        self._last_fsync = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="transcript-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Export every call this writer has open, then stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(("stop", None, None))
+        self._thread.join()
+        self._thread = None
+
+    def append(self, call_sid, record):
+        """Queue one transcript record for a call."""
+        self._queue.put(("append", call_sid, record))
+
+    def export(self, call_sid):
+        """Queue the end-of-call compaction of a call's lines into its .json array."""
+        self._queue.put(("export", call_sid, None))
+
+    def paths(self, call_sid):
+        stem = os.path.join(self.directory, f"call_{call_sid}_{datetime.datetime.now().strftime('%Y%m%d')}")
+        if self.part is None:
+            return stem + ".jsonl", stem + ".json"
+        return f"{stem}.{self.part}.jsonl", stem + ".json"
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        running = True
+        while running:
+            try:
+                op, call_sid, record = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                op = None
+            while op is not None:
+                try:
+                    if op == "append":
+                        self._write(call_sid, record)
+                    elif op == "export":
+                        self._export(call_sid)
+                    elif op == "stop":
+                        running = False
+                except Exception as e:
+                    print(f"Error saving transcript: {e}")
+                try:
+                    op, call_sid, record = self._queue.get_nowait()
+                except queue.Empty:
+                    op = None
+            self._sync(force=not running)
+        for call_sid in list(self._files):
+            try:
+                self._export(call_sid)
+            except Exception as e:
+                print(f"Error saving transcript: {e}")
+
+    def _write(self, call_sid, record):
+        handle = self._files.get(call_sid)
+        if handle is None:
+            jsonl_path, _ = self.paths(call_sid)
+            handle = self._files[call_sid] = open(jsonl_path, "a", encoding="utf-8")
+        handle.write(json.dumps(record) + "\n")
+        self._dirty.add(call_sid)
+
+    def _sync(self, force=False):
+        if not self._dirty:
+            return
+        fsync = force or time.monotonic() - self._last_fsync >= self.fsync_interval
+        for call_sid in self._dirty:
+            handle = self._files.get(call_sid)
+            if handle is None:
+                continue
+            handle.flush()
+            if fsync:
+                os.fsync(handle.fileno())
+        if fsync:
+            self._dirty.clear()
+            self._last_fsync = time.monotonic()
+
+    def _export(self, call_sid):
+        jsonl_path, json_path = self.paths(call_sid)
+        handle = self._files.pop(call_sid, None)
+        if handle is not None:
+            # The call may have started before midnight
+            jsonl_path = handle.name
+            json_path = os.path.join(os.path.dirname(jsonl_path), os.path.basename(jsonl_path).split(".")[0] + ".json")
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+            self._dirty.discard(call_sid)
+        if not os.path.exists(jsonl_path):
+            return
+        with self._merge_lock(json_path):
+            records = []
+            if os.path.exists(json_path):
+                # A call that keeps going after an export just extends the array
+                with open(json_path, encoding="utf-8") as f:
+                    records = json.load(f)
+            with open(jsonl_path, encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+            if self.part is not None:
+                # Interleave this worker's turns with those merged by others
+                records.sort(key=lambda record: record.get("timestamp", ""))
+            with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(records, f, indent=2)
+            os.replace(json_path + ".tmp", json_path)
+            os.remove(jsonl_path)
+        print(f"Saved transcript to {json_path}")
+
+    @contextlib.contextmanager
+    def _merge_lock(self, json_path):
+        """Hold an exclusive lock on a call's .json while merging a part into it."""
+        if self.part is None or fcntl is None:
+            yield
+            return
+        with open(json_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
@@ -0,0 +1,91 @@
+import base64
+import collections
+
+from pacing import MULAW_BYTES_PER_MS, mulaw_duration_ms
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+
+def _mulaw_power_table():
+    """Squared linear sample value for every g711 μ-law byte."""
+    codes = ~np.arange(256, dtype=np.uint8)
+    sign = codes & 0x80
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = (((mantissa.astype(np.int32) << 3) + 0x84) << exponent) - 0x84
+    linear = np.where(sign != 0, -magnitude, magnitude)
+    return linear.astype(np.float64) ** 2
+
+
+_POWER = _mulaw_power_table() if NUMPY_AVAILABLE else None
+_FULL_SCALE_POWER = 32768.0 ** 2
+
+
+def frame_power(audio):
+    """Mean power of μ-law audio as a fraction of full scale."""
+    # take() + sum() is about twice as fast as fancy indexing + mean() on 160-byte frames
+    return _POWER.take(np.frombuffer(audio, dtype=np.uint8)).sum() / (len(audio) * _FULL_SCALE_POWER)
+
+
+def frame_powers(frames):
+    """frame_power() for a 2-D uint8 array of equal-length frames at once."""
+    return _POWER[frames].mean(axis=1) / _FULL_SCALE_POWER
+
+
+class VoiceGate:
+    """
+    Energy-based voice activity gate for inbound caller audio.
+
+    Frames louder than threshold_dbfs open the gate. It stays open for
+    hangover_ms after the last loud frame, which has to be longer than the
+    server_vad silence_duration_ms so OpenAI still hears the pause that ends
+    the turn. While the gate is closed frames are held back, and the last
+    preroll_ms of them are sent ahead of the frame that reopens it so speech
+    onsets aren't clipped.
+
+    Requires NumPy.
+    """
+
+    def __init__(self, threshold_dbfs=-45.0, hangover_ms=800.0, preroll_ms=100.0):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("VoiceGate requires NumPy")
+        self.threshold = 10 ** (threshold_dbfs / 10)
+        self.hangover_ms = hangover_ms
+        self.preroll_ms = preroll_ms
+        self.frames_in = 0
+        self.frames_out = 0
+        self._open_ms = 0.0
+        self._preroll = collections.deque()
+        self._preroll_ms = 0.0
+
+    def process(self, payload):
+        """Return the base64 frames to send upstream for an inbound base64 frame."""
+        audio = base64.b64decode(payload)
+        duration = len(audio) / MULAW_BYTES_PER_MS
+        self.frames_in += 1
+        if frame_power(audio) >= self.threshold:
+            self._open_ms = self.hangover_ms
+            if self._preroll:
+                frames = (*self._preroll, payload)
+                self._preroll.clear()
+                self._preroll_ms = 0.0
+                self.frames_out += len(frames)
+                return frames
+        elif self._open_ms > 0:
+            self._open_ms -= duration
+        else:
+            self._preroll.append(payload)
+            self._preroll_ms += duration
+            while self._preroll_ms > self.preroll_ms:
+                self._preroll_ms -= mulaw_duration_ms(self._preroll.popleft())
+            return ()
+        self.frames_out += 1
+        return (payload,)
+
+    def stats(self):
+        return {"frames_in": self.frames_in, "frames_out": self.frames_out}
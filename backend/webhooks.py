@@ -0,0 +1,491 @@
+import asyncio
+import collections
+import inspect
+import json
+import time
+import httpx
+
+
+class _CallQueue:
+    """Outbound events for one call plus the task that drains them."""
+
+    __slots__ = ("items", "arrived", "flush_now", "task")
+
+    def __init__(self):
+        self.items = collections.deque()
+        # Set whenever an item is queued, to wake an idle drain task
+        self.arrived = asyncio.Event()
+        self.flush_now = asyncio.Event()
+        self.task = None
+
+
+def _is_partial(item):
+    kind, payload = item
+    return kind == "transcriptions" and payload.get("is_partial")
+
+
+def _is_emergency(item):
+    kind, payload = item
+    return kind == "insights" and payload.get("type") == "emergency"
+
+
+class HttpSink:
+    """Posts batches as JSON to a URL over its own keep-alive connection pool."""
+
+    def __init__(self, url, timeout=10.0, max_connections=20):
+        self.name = url
+        self.url = url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client = None
+
+    async def open(self):
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=30.0
+            ),
+            headers={"Content-Type": "application/json"}
+        )
+
+    async def send(self, data):
+        response = await self._client.post(self.url, json=data)
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} - {response.text}")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class FileSink:
+    """Appends batches to a file as JSON lines."""
+
+    def __init__(self, path):
+        self.name = f"file:{path}"
+        self.path = path
+        self._file = None
+
+    async def open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    async def send(self, data):
+        await asyncio.to_thread(self._write, json.dumps(data) + "\n")
+
+    def _write(self, line):
+        self._file.write(line)
+        self._file.flush()
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CallbackSink:
+    """Hands batches to an in-process callable, which may be sync or async."""
+
+    def __init__(self, callback, name=None):
+        self.name = name or getattr(callback, "__name__", "callback")
+        self.callback = callback
+
+    async def open(self):
+        pass
+
+    async def send(self, data):
+        result = self.callback(data)
+        if inspect.isawaitable(result):
+            await result
+
+    async def close(self):
+        pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a sink after failure_threshold failures in a row.
+
+    While open, allow() refuses everything until reset_timeout seconds have
+    passed; then a single probe is let through, and its result closes the
+    breaker again or reopens it for another reset_timeout.
+    """
+
+    __slots__ = ("failure_threshold", "reset_timeout", "failures", "opened_at", "probing")
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def rejecting(self):
+        """Whether calls are refused outright, with no probe due yet."""
+        return (self.opened_at is not None and not self.probing
+                and time.monotonic() - self.opened_at < self.reset_timeout)
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class _SinkWorker:
+    """
+    Delivers batches to one sink from its own bounded queue.
+
+    Failed sends are retried with backoff, but retries come out of a budget
+    that only grows by retry_ratio per batch sent, so a failing sink can't
+    multiply its own traffic. When the queue is full the oldest batch is
+    dropped; while the sink's breaker is open, batches are dropped on arrival.
+    """
+
+    def __init__(self, sink, max_queue=100, max_retries=2, retry_delay=0.5, retry_ratio=0.2,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.sink = sink
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_ratio = retry_ratio
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.counters = {"sent": 0, "failed": 0, "retries": 0, "dropped": 0, "short_circuited": 0}
+        # Retries still allowed; starts with enough for a short outage
+        self.retry_budget = float(max_retries)
+        self._queue = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    async def start(self):
+        await self.sink.open()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Deliver what is queued, then close the sink."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.sink.close()
+
+    def offer(self, data, count):
+        if self.breaker.rejecting:
+            self.counters["short_circuited"] += count
+            return
+        if len(self._queue) >= self.max_queue:
+            _, dropped = self._queue.popleft()
+            self.counters["dropped"] += dropped
+        self._queue.append((data, count))
+        self._wakeup.set()
+
+    def stats(self):
+        return dict(self.counters, state=self.breaker.state, queued=len(self._queue))
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            data, count = self._queue.popleft()
+            await self._deliver(data, count)
+
+    async def _deliver(self, data, count):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.counters["short_circuited"] += count
+                return
+            try:
+                await self.sink.send(data)
+            except Exception as e:
+                self.breaker.record_failure()
+                print(f"Error sending to webhook sink {self.sink.name}: {e}")
+                if attempt >= self.max_retries or self.retry_budget < 1 or self._closing:
+                    self.counters["failed"] += count
+                    return
+                self.retry_budget -= 1
+                self.counters["retries"] += 1
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            self.counters["sent"] += count
+            self.retry_budget = min(self.retry_budget + self.retry_ratio, 10.0)
+            return
+
+
+class WebhookDispatcher:
+    """
+    Long-lived webhook sender shared by every call.
+
+    Each call gets a bounded queue and its own drain task, so callers only
+    ever append to a deque and never wait on the frontend. The drain task
+    coalesces queued events into the frontend's
+    {"transcriptions": [...], "insights": [...]} payload, either when
+    max_batch items are waiting or flush_interval seconds after the first
+    one arrived, and fans each batch out to every sink.
+
+    Sinks are webhook URLs (HttpSink), JSON-lines files (FileSink) or
+    in-process callables (CallbackSink), added with add_sink(). Each has its
+    own worker, queue, retry budget and circuit breaker, so a slow or dead
+    sink only loses its own batches and never holds up the others.
+
+    When a call's queue is full the oldest partial transcript is dropped
+    first, then the oldest ordinary event. Emergency insights are never
+    dropped and are flushed without waiting for the batch window.
+    """
+
+    def __init__(self, urls=(), max_batch=20, flush_interval=0.25, max_queue=200,
+                 idle_timeout=30.0, timeout=10.0, max_connections=20, sink_queue=100,
+                 max_retries=2, retry_ratio=0.2, failure_threshold=5, reset_timeout=30.0, debug=False):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.sink_queue = sink_queue
+        self.max_retries = max_retries
+        self.retry_ratio = retry_ratio
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.debug = debug
+        self.counters = {
+            "enqueued": 0,
+            "batches": 0,
+            "dropped_partial": 0,
+            "dropped": 0,
+            "max_depth": 0,
+        }
+        self._sinks = []
+        self._queues = {}
+        # Start tasks of sinks added while running
+        self._starting = set()
+        self._started = False
+        self._closing = False
+        for url in urls:
+            self.add_sink(HttpSink(url, timeout=timeout, max_connections=max_connections))
+
+    def add_sink(self, sink):
+        """Deliver every batch to sink too; sinks added after start() are started with it."""
+        worker = _SinkWorker(
+            sink,
+            max_queue=self.sink_queue,
+            max_retries=self.max_retries,
+            retry_ratio=self.retry_ratio,
+            failure_threshold=self.failure_threshold,
+            reset_timeout=self.reset_timeout
+        )
+        self._sinks.append(worker)
+        if self._started:
+            task = asyncio.create_task(worker.start())
+            self._starting.add(task)
+            task.add_done_callback(self._sink_started)
+        return sink
+
+    async def start(self):
+        """Open every sink and start its worker."""
+        if self._started:
+            return
+        self._started = True
+        self._closing = False
+        for worker in self._sinks:
+            await worker.start()
+
+    async def stop(self):
+        """Drain every call's queue, then let each sink deliver what it has and close."""
+        self._closing = True
+        tasks = []
+        for queue in self._queues.values():
+            queue.arrived.set()
+            queue.flush_now.set()
+            tasks.append(queue.task)
+        await asyncio.gather(*tasks, *self._starting, return_exceptions=True)
+        await asyncio.gather(*(worker.stop() for worker in self._sinks), return_exceptions=True)
+        self._started = False
+
+    def submit(self, call_sid, transcriptions=(), insights=()):
+        """Queue transcriptions/insights for a call without waiting on the network."""
+        queue = self._queues.get(call_sid)
+        if queue is None:
+            queue = self._queues[call_sid] = _CallQueue()
+            queue.task = asyncio.create_task(self._drain(call_sid, queue))
+        for transcription in transcriptions:
+            self._enqueue(queue, ("transcriptions", transcription))
+        for insight in insights:
+            self._enqueue(queue, ("insights", insight))
+        if len(queue.items) >= self.max_batch:
+            queue.flush_now.set()
+
+    def offer_local(self, data):
+        """
+        Hand a batch straight to every sink that isn't a webhook URL, e.g. an
+        emergency alert that the URLs already get from the alert outbox.
+        """
+        count = len(data.get("transcriptions", ())) + len(data.get("insights", ()))
+        for worker in self._sinks:
+            if not isinstance(worker.sink, HttpSink):
+                worker.offer(data, count)
+
+    def flush(self, call_sid):
+        """Ask a call's drain task to send what it has without waiting for the batch window."""
+        queue = self._queues.get(call_sid)
+        if queue is not None:
+            queue.flush_now.set()
+
+    def stats(self):
+        """Counters plus the current queue depth across all calls, and each sink's delivery stats."""
+        return dict(
+            self.counters,
+            calls=len(self._queues),
+            depth=sum(len(queue.items) for queue in self._queues.values()),
+            sinks={worker.sink.name: worker.stats() for worker in self._sinks}
+        )
+
+    def _sink_started(self, task):
+        self._starting.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error starting webhook sink: {task.exception()}")
+
+    def _enqueue(self, queue, item):
+        if len(queue.items) >= self.max_queue and not self._make_room(queue):
+            if not _is_emergency(item):
+                self.counters["dropped"] += 1
+                return
+        queue.items.append(item)
+        queue.arrived.set()
+        self.counters["enqueued"] += 1
+        if len(queue.items) > self.counters["max_depth"]:
+            self.counters["max_depth"] = len(queue.items)
+        if _is_emergency(item):
+            queue.flush_now.set()
+
+    def _make_room(self, queue):
+        for predicate, counter in ((_is_partial, "dropped_partial"),
+                                   (lambda item: not _is_emergency(item), "dropped")):
+            for index, queued in enumerate(queue.items):
+                if predicate(queued):
+                    del queue.items[index]
+                    self.counters[counter] += 1
+                    return True
+        return False
+
+    async def _drain(self, call_sid, queue):
+        while True:
+            if not queue.items:
+                if self._closing:
+                    break
+                queue.arrived.clear()
+                queue.flush_now.clear()
+                try:
+                    await asyncio.wait_for(queue.arrived.wait(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if not queue.items:
+                    break
+            if not queue.flush_now.is_set() and not self._closing:
+                try:
+                    await asyncio.wait_for(queue.flush_now.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            queue.flush_now.clear()
+            data = {"transcriptions": [], "insights": []}
+            for _ in range(min(self.max_batch, len(queue.items))):
+                kind, payload = queue.items.popleft()
+                data[kind].append(payload)
+            if len(queue.items) >= self.max_batch or any(map(_is_emergency, queue.items)):
+                queue.flush_now.set()
+            self._fan_out(data)
+        if self._queues.get(call_sid) is queue:
+            del self._queues[call_sid]
+
+    def _fan_out(self, data):
+        count = len(data["transcriptions"]) + len(data["insights"])
+        self.counters["batches"] += 1
+        if self.debug:
+            print(f"Sending to webhook: {json.dumps(data, indent=2)}")
+        for worker in self._sinks:
+            worker.offer(data, count)
+
+
+class PartialDebouncer:
+    """
+    Latest-wins throttle for partial transcripts.
+
+    update() only remembers the newest text for a (call_sid, message_type)
+    pair; at most once per interval the latest one is handed to emit. flush()
+    sends the pending text immediately, e.g. when the utterance is done.
+    emit is an async callable taking (call_sid, message_type, content).
+    """
+
+    def __init__(self, emit, interval=0.15):
+        self.emit = emit
+        self.interval = interval
+        self._latest = {}
+        self._timers = {}
+        # Running emits, kept so they aren't garbage-collected mid-send
+        self._tasks = set()
+
+    def update(self, call_sid, message_type, content):
+        key = (call_sid, message_type)
+        self._latest[key] = content
+        if key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.interval, self._fire, key)
+
+    async def flush(self, call_sid, message_type):
+        key = (call_sid, message_type)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        content = self._latest.pop(key, None)
+        if content is not None:
+            await self.emit(call_sid, message_type, content)
+
+    def discard(self, call_sid):
+        """Forget anything pending for a call without sending it."""
+        for key in [key for key in self._latest if key[0] == call_sid]:
+            self._latest.pop(key, None)
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+
+    def _fire(self, key):
+        self._timers.pop(key, None)
+        content = self._latest.pop(key, None)
+        if content is not None:
+            task = asyncio.create_task(self.emit(key[0], key[1], content))
+            self._tasks.add(task)
+            task.add_done_callback(self._emitted)
+
+    def _emitted(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error sending partial transcript: {task.exception()}")
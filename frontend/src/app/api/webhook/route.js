@@ -11,6 +11,9 @@ let latestData = {
 // Maximum number of items to keep in memory
 const MAX_ITEMS = 100;
 
+// Backend whose /live stream the dashboard reads; test messages are relayed to it
+const BACKEND_URL = process.env.BACKEND_URL || process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:5050';
+
 /**
  * Simple webhook endpoint to receive JSON data from external pipeline
  */
@@ -79,6 +82,19 @@ export async function POST(request) {
       }
     }
     
+    // Test messages from the dashboard only reach its live view through the backend's stream.
+    // Batches the backend itself sends are already on that stream, so they are not relayed back.
+    if (data.test) {
+      const relayed = await fetch(`${BACKEND_URL}/live`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(data),
+      });
+      if (!relayed.ok) {
+        throw new Error(`Backend rejected test message with ${relayed.status}`);
+      }
+    }
+    
     // Return success response
     return NextResponse.json({ 
       success: true, 
@@ -34,6 +34,12 @@ import "leaflet/dist/leaflet.css";
 // Phone number for emergency calls
 const EMERGENCY_PHONE_NUMBER = "+18777063518";
 
+// Backend endpoint streaming live transcripts and insights as Server-Sent Events
+const LIVE_URL = `${process.env.NEXT_PUBLIC_BACKEND_URL || "http://localhost:5050"}/live`;
+
+// Maximum number of transcriptions and insights to keep on screen
+const MAX_ITEMS = 100;
+
 // Dynamically import the Map component with no SSR to avoid hydration issues
 const MapComponent = dynamic(
   () => import("../components/MapComponent"),
@@ -140,9 +146,6 @@ export default function Dashboard() {
       ...callInfo,
       startTime: new Date().toISOString(),
     });
-
-    // Fetch initial data when starting a call
-    fetchLatestData();
   };
 
   // Function to end a call
@@ -152,7 +155,7 @@ export default function Dashboard() {
     setInsights([]);
   };
 
-  // Function to send a test message to the webhook
+  // Function to add a test message to the live view
   const sendTestMessage = async () => {
     if (!testMessage.trim()) return;
 
@@ -174,7 +177,9 @@ export default function Dashboard() {
             sentiment: testSpeaker === "Caller" ? "anxious" : "supportive",
           },
         ],
-        insights: []
+        insights: [],
+        // Relayed by /api/webhook to the backend, which sends it back on the live stream
+        test: true
       };
       
       // Add insight if it's a caller message with "help"
@@ -199,81 +204,52 @@ export default function Dashboard() {
         throw new Error("Failed to send data to webhook");
       }
 
-      // Clear the input field
+      // Clear the input field; the message shows up when it comes back on the live stream
       setTestMessage("");
-
-      // Fetch the latest data
-      fetchLatestData();
     } catch (error) {
       console.error("Error sending test message:", error);
       alert("Failed to send test message: " + error.message);
     }
   };
 
-  // Function to fetch the latest data from the webhook
-  const fetchLatestData = async () => {
-    try {
-      const response = await fetch("/api/webhook");
-
-      if (!response.ok) {
-        throw new Error("Failed to fetch data from webhook");
-      }
+  // Add a transcription: a partial replaces the speaker's previous partial in the
+  // same call, and the final transcription replaces the partial it completes
+  const mergeTranscription = (transcription) => {
+    setTranscriptions(prev => {
+      const rest = prev.filter(t =>
+        t.id !== transcription.id &&
+        !(t.is_partial && t.call_sid === transcription.call_sid && t.speaker === transcription.speaker)
+      );
+      return [...rest, transcription].sort((a, b) => a.id - b.id).slice(-MAX_ITEMS);
+    });
+  };
 
-      const data = await response.json();
+  // Add an insight unless it was already shown, raising the alarm for emergencies
+  const mergeInsight = (insight) => {
+    setInsights(prev => {
+      if (prev.some(i => i.id === insight.id)) return prev;
+      return [...prev, insight].sort((a, b) => a.id - b.id).slice(-MAX_ITEMS);
+    });
 
-      // Update the local state with the fetched data
-      if (data.transcriptions && Array.isArray(data.transcriptions)) {
-        // Filter out partial transcriptions if there are complete ones
-        const completeTranscriptions = data.transcriptions.filter(t => !t.is_partial);
-        const partialTranscriptions = data.transcriptions.filter(t => t.is_partial);
-        
-        // Only keep partial transcriptions if there are no complete ones
-        if (completeTranscriptions.length > 0) {
-          setTranscriptions(completeTranscriptions);
-        } else {
-          setTranscriptions(data.transcriptions);
-        }
-        
-        // Sort transcriptions by ID (chronological order)
-        setTranscriptions(prev => [...prev].sort((a, b) => a.id - b.id));
-      }
-      
-      if (data.insights && Array.isArray(data.insights)) {
-        setInsights(data.insights);
-        // Sort insights by ID (chronological order)
-        setInsights(prev => [...prev].sort((a, b) => a.id - b.id));
-        
-        // Check for emergency insights
-        const foundEmergencyInsight = data.insights.find(insight => 
-          insight.type === "emergency" && insight.action === "notify_police"
-        );
-        
-        if (foundEmergencyInsight && !emergencyDetected) {
-          setEmergencyInsight(foundEmergencyInsight);
-          setEmergencyDetected(true);
-        }
-      }
-      
-      console.log('Fetched data from webhook:', {
-        transcriptionsCount: data.transcriptions?.length || 0,
-        insightsCount: data.insights?.length || 0
-      });
-    } catch (error) {
-      console.error("Error fetching latest data:", error);
+    if (insight.type === "emergency" && insight.action === "notify_police") {
+      setEmergencyInsight(current => current || insight);
+      setEmergencyDetected(true);
     }
   };
 
-  // Fetch the latest data when the modal is opened
+  // Stream transcripts and insights from the backend while the modal is open.
+  // The backend first replays its recent events, and EventSource reconnects on
+  // its own, resuming after the last event it received.
   useEffect(() => {
-    if (isActiveCallModalOpen) {
-      fetchLatestData();
+    if (!isActiveCallModalOpen) return;
 
-      // Set up polling to fetch data every 2 seconds
-      const intervalId = setInterval(fetchLatestData, 2000);
+    const source = new EventSource(LIVE_URL);
+    source.addEventListener("transcription", (event) => mergeTranscription(JSON.parse(event.data)));
+    source.addEventListener("insight", (event) => mergeInsight(JSON.parse(event.data)));
+    source.onerror = () => console.warn("Live stream interrupted, reconnecting...");
 
-      // Clean up the interval when the modal is closed
-      return () => clearInterval(intervalId);
-    }
+    // Close the stream when the modal is closed
+    return () => source.close();
   }, [isActiveCallModalOpen]);
 
   // Track location when the modal is opened